@@ -1,4 +1,5 @@
 import os
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 from sqlalchemy import create_engine, MetaData, Table
@@ -15,6 +16,30 @@ DB_PASSWORD = os.getenv('POSTGRES_PASSWORD')
 DB_HOST = 'postgres'
 DB_PORT = '5432'
 
+CHUNK_SIZE = int(os.getenv('LOAD_CHUNKSIZE', 100000))
+
+EVENT_TIME_FORMAT = '%Y-%m-%d %H:%M:%S UTC'
+
+CSV_DTYPES = {
+    "event_time": "object",
+    "event_type": "category",
+    "product_id": "int32",
+    "price": "float64",
+    "user_id": "int64",
+    "user_session": "object"
+}
+
+DATA_TYPES = {
+    "event_time": sqlalchemy.DateTime(),
+    "event_type": sqlalchemy.types.String(length=255),
+    "product_id": sqlalchemy.types.Integer(),
+    "price": sqlalchemy.types.Float(),
+    "user_id": sqlalchemy.types.BigInteger(),
+    "user_session": sqlalchemy.types.UUID(as_uuid=True)
+}
+
+HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+
 
 def start_timer():
     global start_time
@@ -24,7 +49,51 @@ def start_timer():
         time.sleep(1)
 
 
-def load(path, tableName):
+def session_to_bytes(sessions):
+    """Encode UUID strings as 16 raw bytes, missing sessions stay None"""
+    missing = sessions.isna()
+    digits = sessions.where(~missing, '0' * 32).str.replace('-', '', regex=False)
+    raw = np.frombuffer(bytes.fromhex(''.join(digits)), dtype='S16')
+    encoded = pd.Series(raw, index=sessions.index, dtype=object)
+    encoded[missing] = None
+    return encoded
+
+
+def session_to_text(sessions):
+    """Format 16 byte sessions back to UUID strings"""
+    missing = sessions.isna().to_numpy()
+    raw = np.asarray(sessions.where(~missing, b''), dtype='S16').view(np.uint8).reshape(-1, 16)
+    text = np.full((len(raw), 36), ord('-'), dtype=np.uint8)
+    positions = np.array([0, 2, 4, 6, 9, 11, 14, 16, 19, 21, 24, 26, 28, 30, 32, 34])
+    text[:, positions] = HEX_DIGITS[raw >> 4]
+    text[:, positions + 1] = HEX_DIGITS[raw & 15]
+    formatted = pd.Series(text.view('S36').ravel().astype(str), index=sessions.index, dtype=object)
+    formatted[missing] = None
+    return formatted
+
+
+def convert_chunk(chunk):
+    """Convert the column types of a chunk before writing it"""
+    # dropping the ' UTC' suffix keeps pandas on its fast ISO 8601 parser
+    chunk['event_time'] = pd.to_datetime(chunk['event_time'].str.slice(0, 19), format='%Y-%m-%d %H:%M:%S')
+    chunk['user_session'] = session_to_bytes(chunk['user_session'])
+    return chunk
+
+
+def read_csv_chunks(path, chunksize=CHUNK_SIZE):
+    """Read a customer CSV in typed chunks"""
+    reader = pd.read_csv(path, chunksize=chunksize, dtype=CSV_DTYPES)
+    for chunk in reader:
+        yield convert_chunk(chunk)
+
+
+def write_chunk(chunk, tableName, engine):
+    """Append a typed chunk to a table"""
+    chunk = chunk.assign(user_session=session_to_text(chunk['user_session']))
+    chunk.to_sql(tableName, engine, if_exists='append', index=False, dtype=DATA_TYPES)
+
+
+def load(path, tableName, chunksize=CHUNK_SIZE):
     try:
         DATABASE_URL = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
 
@@ -35,16 +104,8 @@ def load(path, tableName):
             print(f"Table {tableName} already exists")
         else:
             print(f"Table {tableName} doesn't exist, creating...")
-            data = pd.read_csv(path)
-            data_types = {
-                "event_time": sqlalchemy.DateTime(),
-                "event_type": sqlalchemy.types.String(length=255),
-                "product_id": sqlalchemy.types.Integer(),
-                "price": sqlalchemy.types.Float(),
-                "user_id": sqlalchemy.types.BigInteger(),
-                "user_session": sqlalchemy.types.UUID(as_uuid=True)
-            }
-            data.to_sql(tableName, engine, index=False, dtype=data_types)
+            for chunk in read_csv_chunks(path, chunksize):
+                write_chunk(chunk, tableName, engine)
             print(f"Table {tableName} created")
 
         engine.dispose()
@@ -5,6 +5,8 @@ from psycopg2 import sql
 from dotenv import load_dotenv
 from datetime import datetime
 from tqdm import tqdm
+import io
+import time
 
 load_dotenv(dotenv_path="../.env")
 
@@ -14,21 +16,21 @@ DB_PASSWORD = os.getenv('POSTGRES_PASSWORD')
 DB_HOST = 'postgres'
 DB_PORT = '5432'
 
-def create_table_from_csv(file_path):
-    df = pd.read_csv(file_path)
+columns = [
+    ("event_time", "TIMESTAMP"),
+    ("event_type", "VARCHAR(255)"),
+    ("product_id", "BIGINT"),
+    ("price", "NUMERIC"),
+    ("user_id", "INTEGER"),
+    ("user_session", "TEXT")
+]
+
+BATCH_SIZE = 100000
 
-    table_name = 'data_2022_dec'
 
-    columns = [
-        ("event_time", "TIMESTAMP"),
-        ("event_type", "VARCHAR(255)"),
-        ("product_id", "BIGINT"),
-        ("price", "NUMERIC"),
-        ("user_id", "INTEGER"),
-        ("user_session", "TEXT")
-    ]
-        
-    create_table_query = sql.SQL(
+def get_create_table_query(table_name):
+    """Build the CREATE TABLE query for the customer columns"""
+    return sql.SQL(
         "CREATE TABLE IF NOT EXISTS {} (id SERIAL PRIMARY KEY, {})"
     ).format(
         sql.Identifier(table_name),
@@ -36,7 +38,15 @@ def create_table_from_csv(file_path):
             sql.SQL("{} {}").format(sql.Identifier(col_name), sql.SQL(col_type)) for col_name, col_type in columns
         )
     )
-    
+
+
+def create_table_from_csv(file_path):
+    df = pd.read_csv(file_path)
+
+    table_name = 'data_2022_dec'
+
+    create_table_query = get_create_table_query(table_name)
+
     conn = psycopg2.connect(
         dbname=DB_NAME,
         user=DB_USER,
@@ -70,11 +80,58 @@ def create_table_from_csv(file_path):
     print("\Conection closed")
 
 
+def copy_table_from_csv(file_path, table_name='data_2022_dec', batch_size=BATCH_SIZE):
+    """Bulk load a CSV into a table with COPY FROM STDIN, one batch at a time"""
+    column_names = [col_name for col_name, _ in columns]
+
+    copy_query = sql.SQL(
+        "COPY {} ({}) FROM STDIN WITH (FORMAT csv)"
+    ).format(
+        sql.Identifier(table_name),
+        sql.SQL(", ").join(sql.Identifier(col_name) for col_name in column_names)
+    )
+
+    conn = psycopg2.connect(
+        dbname=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        host=DB_HOST,
+        port=DB_PORT
+    )
+    cursor = conn.cursor()
+
+    start_time = time.time()
+    total_rows = 0
+    try:
+        cursor.execute(get_create_table_query(table_name))
+
+        for chunk in tqdm(pd.read_csv(file_path, usecols=column_names, chunksize=batch_size), unit='batch'):
+            chunk = chunk[column_names]
+            chunk['event_time'] = pd.to_datetime(chunk['event_time'], format='%Y-%m-%d %H:%M:%S UTC')
+
+            buffer = io.StringIO()
+            chunk.to_csv(buffer, index=False, header=False, date_format='%Y-%m-%d %H:%M:%S')
+            buffer.seek(0)
+            cursor.copy_expert(copy_query, buffer)
+            total_rows += len(chunk)
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+    elapsed_time = time.time() - start_time
+    print(f"Loaded {total_rows} rows into {table_name} in {elapsed_time:.2f} secs "
+          f"({total_rows / max(elapsed_time, 1e-9):.0f} rows/sec)")
+
 
 if __name__ == '__main__':
     csv_file_path = '../subject/customer/data_2022_dec.csv'
 
     try:
-        create_table_from_csv(csv_file_path)
+        copy_table_from_csv(csv_file_path)
     except Exception as e:
         print(e)
\ No newline at end of file
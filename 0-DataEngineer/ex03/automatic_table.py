@@ -1,18 +1,188 @@
 import os
+import csv
+import gzip
+import hashlib
+import itertools
+import re
+import numpy as np
 import pandas as pd
-from dotenv import load_dotenv
-from sqlalchemy import create_engine, MetaData, Table
+from sqlalchemy import MetaData, Table, text
 import sqlalchemy
 import threading
 import time
+import queue
+import io
+import zstandard
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+import sys
 
-load_dotenv(dotenv_path="../.env")
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metrics import measure  # noqa: E402
+from db import get_engine  # noqa: E402
 
-DB_NAME = os.getenv('POSTGRES_DB')
-DB_USER = os.getenv('POSTGRES_USER')
-DB_PASSWORD = os.getenv('POSTGRES_PASSWORD')
-DB_HOST = 'postgres'
-DB_PORT = '5432'
+CHUNK_SIZE = int(os.getenv('LOAD_CHUNKSIZE', 100000))
+
+#bytes read per line of a chunk, customer lines are about 100 bytes long, chunks end on a whole line
+LINE_BYTES = 128
+
+EVENT_TIME_FORMAT = '%Y-%m-%d %H:%M:%S UTC'
+
+CSV_DTYPES = {
+    "event_type": "category",
+    "product_id": "int32",
+    "price": "float64",
+    "user_id": "int64"
+}
+
+EVENT_TYPES = ['view', 'cart', 'remove_from_cart', 'purchase']
+
+UUID_PATTERN = r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}'
+
+DATA_TYPES = {
+    "event_time": sqlalchemy.DateTime(),
+    "event_type": sqlalchemy.types.String(length=255),
+    "product_id": sqlalchemy.types.Integer(),
+    "price": sqlalchemy.types.Float(),
+    "user_id": sqlalchemy.types.BigInteger(),
+    "user_session": sqlalchemy.types.UUID(as_uuid=True)
+}
+
+HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+
+BINARY_COLUMNS = {
+    "event_time": "timestamp",
+    "event_type": "text",
+    "product_id": "int4",
+    "price": "float8",
+    "user_id": "int8",
+    "user_session": "uuid"
+}
+
+BINARY_NUMPY_TYPES = {"int4": '>i4', "int8": '>i8', "float8": '>f8'}
+
+BINARY_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + bytes(8)
+
+BINARY_COPY_TRAILER = b'\xff\xff'
+
+POSTGRES_EPOCH = np.datetime64('2000-01-01T00:00:00', 'us')
+
+LOAD_WRITER = os.getenv('LOAD_WRITER', 'to_sql')
+
+LOAD_WORKERS = int(os.getenv('LOAD_WORKERS', os.cpu_count() or 1))
+
+QUEUE_SIZE = int(os.getenv('LOAD_QUEUE_SIZE', 4))
+
+PIPELINE_DONE = object()
+
+CSV_EXTENSIONS = ('.csv', '.csv.gz', '.csv.zst')
+
+sql_create_manifest = """
+CREATE TABLE IF NOT EXISTS ingestion_manifest (
+    file_path TEXT PRIMARY KEY,
+    table_name TEXT NOT NULL,
+    file_size BIGINT NOT NULL,
+    file_mtime DOUBLE PRECISION NOT NULL,
+    content_hash TEXT NOT NULL,
+    row_count BIGINT NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    loaded_at TIMESTAMP
+);
+"""
+
+sql_get_manifest = """
+SELECT file_size, file_mtime, content_hash, row_count, status
+FROM ingestion_manifest
+WHERE file_path = :file_path;
+"""
+
+sql_start_manifest = """
+INSERT INTO ingestion_manifest
+    (file_path, table_name, file_size, file_mtime, content_hash, row_count, status)
+VALUES
+    (:file_path, :table_name, :file_size, :file_mtime, :content_hash, :row_count, 'loading')
+ON CONFLICT (file_path) DO UPDATE SET
+    table_name = EXCLUDED.table_name,
+    file_size = EXCLUDED.file_size,
+    file_mtime = EXCLUDED.file_mtime,
+    content_hash = EXCLUDED.content_hash,
+    row_count = EXCLUDED.row_count,
+    status = 'loading',
+    loaded_at = NULL;
+"""
+
+sql_checkpoint_manifest = """
+UPDATE ingestion_manifest SET row_count = row_count + :rows WHERE file_path = :file_path;
+"""
+
+sql_finish_manifest = """
+UPDATE ingestion_manifest
+SET status = 'loaded', file_mtime = :file_mtime, loaded_at = now()
+WHERE file_path = :file_path;
+"""
+
+sql_create_quarantine = """
+CREATE TABLE IF NOT EXISTS ingestion_quarantine (
+    source_file TEXT NOT NULL,
+    line_number BIGINT NOT NULL,
+    reason TEXT NOT NULL,
+    raw_row TEXT,
+    quarantined_at TIMESTAMP NOT NULL DEFAULT now()
+);
+"""
+
+sql_clear_quarantine = """
+DELETE FROM ingestion_quarantine WHERE source_file = :file_path;
+"""
+
+#rows the checkpoint says are in staging, the rejected ones are in the quarantine
+sql_checkpoint_rows = """
+SELECT m.row_count - (SELECT COUNT(*) FROM ingestion_quarantine q WHERE q.source_file = m.file_path)
+FROM ingestion_manifest m
+WHERE m.file_path = :file_path;
+"""
+
+sql_finalize_staging = """
+CREATE INDEX IF NOT EXISTS "{staging}_event_time_idx" ON "{staging}" (event_time);
+ALTER TABLE "{staging}" SET LOGGED;
+ANALYZE "{staging}";
+"""
+
+sql_swap_staging = """
+SET LOCAL lock_timeout = '5s';
+DROP TABLE IF EXISTS "{table}";
+ALTER TABLE "{staging}" RENAME TO "{table}";
+ALTER INDEX "{staging}_event_time_idx" RENAME TO "{table}_event_time_idx";
+"""
+
+#parent, bound and partition key of a table attached as a partition
+sql_partition_of = """
+SELECT p.relname, pg_get_expr(c.relpartbound, c.oid), pg_get_partkeydef(p.oid)
+FROM pg_inherits i
+JOIN pg_class c ON c.oid = i.inhrelid
+JOIN pg_class p ON p.oid = i.inhparent
+WHERE c.oid = to_regclass(%(table)s);
+"""
+
+#a valid CHECK implying the partition bound lets ATTACH skip its scan of the table
+sql_partition_check = """
+ALTER TABLE "{staging}" DROP CONSTRAINT IF EXISTS "{staging}_partition_check";
+ALTER TABLE "{staging}" ADD CONSTRAINT "{staging}_partition_check"
+    CHECK ("{key}" IS NOT NULL AND "{key}" >= {start} AND "{key}" < {end});
+"""
+
+sql_swap_partition = """
+SET LOCAL lock_timeout = '5s';
+ALTER TABLE "{parent}" DETACH PARTITION "{table}";
+DROP TABLE "{table}";
+ALTER TABLE "{staging}" RENAME TO "{table}";
+ALTER INDEX "{staging}_event_time_idx" RENAME TO "{table}_event_time_idx";
+ALTER TABLE "{parent}" ATTACH PARTITION "{table}" {bound};
+ALTER TABLE "{table}" DROP CONSTRAINT IF EXISTS "{staging}_partition_check";
+"""
+
+RANGE_BOUND = re.compile(r"FOR VALUES FROM \(('[^']*')\) TO \(('[^']*')\)")
+RANGE_KEY = re.compile(r"RANGE \((\w+)\)")
 
 
 def start_timer():
@@ -25,36 +195,565 @@ def start_timer():
         time.sleep(1)
 
 
-def load(path, tableName):
+def session_to_bytes(sessions):
+    """Encode UUID strings as 16 raw bytes, missing sessions stay None"""
+    missing = sessions.isna()
+    digits = sessions.where(~missing, '0' * 32).str.replace('-', '', regex=False)
+    raw = np.frombuffer(bytes.fromhex(''.join(digits)), dtype='S16')
+    encoded = pd.Series(raw, index=sessions.index, dtype=object)
+    encoded[missing] = None
+    return encoded
+
+
+def session_to_text(sessions):
+    """Format 16 byte sessions back to UUID strings"""
+    missing = sessions.isna().to_numpy()
+    raw = np.asarray(sessions.where(~missing, b''), dtype='S16').view(np.uint8).reshape(-1, 16)
+    text = np.full((len(raw), 36), ord('-'), dtype=np.uint8)
+    positions = np.array([0, 2, 4, 6, 9, 11, 14, 16, 19, 21, 24, 26, 28, 30, 32, 34])
+    text[:, positions] = HEX_DIGITS[raw >> 4]
+    text[:, positions + 1] = HEX_DIGITS[raw & 15]
+    formatted = pd.Series(text.view('S36').ravel().astype(str), index=sessions.index, dtype=object)
+    formatted[missing] = None
+    return formatted
+
+
+def to_number(values):
+    """Convert a text column to float, invalid values become NaN"""
+    try:
+        return values.astype('float64')
+    except ValueError:
+        return pd.to_numeric(values, errors='coerce')
+
+
+def convert_chunk(chunk):
+    """Validate a raw chunk and convert its valid rows
+
+    Every check is vectorized over the chunk. Returns the typed valid rows
+    and the rejected rows with their source line number and the reason
+    they were rejected, lines with the wrong field count included.
+    """
+    bad_lines = chunk.attrs.pop('bad_lines', None)
+    reason = pd.Series(None, index=chunk.index, dtype=object)
+
+    def reject(invalid, message):
+        reason[invalid & reason.isna()] = message
+
+    # dropping the ' UTC' suffix keeps pandas on its fast ISO 8601 parser
+    event_time = pd.to_datetime(chunk['event_time'].str.slice(0, 19), format='%Y-%m-%d %H:%M:%S', errors='coerce')
+    reject(event_time.isna() | (chunk['event_time'].str.slice(19) != ' UTC'), 'invalid event_time')
+    reject(~chunk['event_type'].isin(EVENT_TYPES), 'unknown event_type')
+
+    numbers = {column: to_number(chunk[column]) for column in ('product_id', 'price', 'user_id')}
+    for column, values in numbers.items():
+        reject(values.isna(), f'invalid {column}')
+    for column in ('product_id', 'user_id'):
+        limits = np.iinfo(CSV_DTYPES[column])
+        values = numbers[column]
+        reject((values % 1 != 0) | (values < limits.min) | (values > limits.max), f'invalid {column}')
+    reject(numbers['price'] < 0, 'negative price')
+
+    sessions = chunk['user_session']
+    reject(sessions.notna() & ~sessions.str.fullmatch(UUID_PATTERN, na=False), 'invalid user_session')
+
+    valid = reason.isna()
+    typed = pd.DataFrame({
+        "event_time": event_time[valid],
+        "event_type": chunk['event_type'][valid].astype(CSV_DTYPES['event_type']),
+        "product_id": numbers['product_id'][valid].astype(CSV_DTYPES['product_id']),
+        "price": numbers['price'][valid].astype(CSV_DTYPES['price']),
+        "user_id": numbers['user_id'][valid].astype(CSV_DTYPES['user_id']),
+        "user_session": session_to_bytes(sessions[valid])
+    })
+
+    invalid_rows = chunk[~valid]
+    rejected = pd.DataFrame({
+        "line_number": invalid_rows.index.to_numpy() + 2,
+        "reason": reason[~valid].to_numpy(),
+        "raw_row": [','.join(row) for row in invalid_rows.fillna('').itertuples(index=False)]
+    })
+    if bad_lines is not None and len(bad_lines):
+        rejected = pd.concat([rejected, bad_lines], ignore_index=True)
+    return typed, rejected
+
+
+def open_csv(path):
+    """Open a plain or compressed CSV as a binary file"""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zst'):
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True))
+    return open(path, 'rb')
+
+
+def line_blocks(f, chunksize):
+    """Read a binary file in blocks of whole lines, about chunksize lines each"""
+    rest = b''
+    while True:
+        data = f.read(chunksize * LINE_BYTES)
+        if not data:
+            break
+        block = rest + data
+        cut = block.rfind(b'\n') + 1
+        if cut:
+            yield block[:cut]
+        rest = block[cut:]
+    if rest:
+        yield rest + b'\n'
+
+
+def field_counts(block):
+    """Count the fields of every line of a block
+
+    Separators are counted with numpy, only lines with quotes are split
+    with the csv module.
+    """
+    data = np.frombuffer(block, dtype=np.uint8)
+    ends = np.flatnonzero(data == ord('\n'))
+    commas = np.flatnonzero(data == ord(','))
+    counts = np.diff(np.searchsorted(commas, ends), prepend=0) + 1
+    quoted = np.unique(np.searchsorted(ends, np.flatnonzero(data == ord('"'))))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    for line in quoted:
+        counts[line] = len(next(csv.reader([block[starts[line]:ends[line]].decode(errors='replace')]), []))
+    return counts, starts, ends
+
+
+def read_raw_chunks(path, chunksize=CHUNK_SIZE, skiprows=0):
+    """Read a customer CSV as text chunks, skipping already loaded rows
+
+    The chunk index is the data row number in the file, already loaded
+    rows included. Lines with the wrong number of fields are left out of
+    the chunk and given in chunk.attrs['bad_lines'] to be quarantined; only
+    a block with such lines is copied again without them.
+    """
+    with open_csv(path) as f:
+        columns = next(csv.reader([f.readline().decode()]))
+        next(itertools.islice(f, skiprows, skiprows), None)
+        row = skiprows
+        for block in line_blocks(f, chunksize):
+            counts, starts, ends = field_counts(block)
+            bad = counts != len(columns)
+            bad_lines = pd.DataFrame(columns=['line_number', 'reason', 'raw_row'])
+            if bad.any():
+                bad_lines = pd.DataFrame({
+                    "line_number": np.flatnonzero(bad) + row + 2,
+                    "reason": [f'wrong field count: expected {len(columns)}, saw {count}' for count in counts[bad]],
+                    "raw_row": [block[start:end].decode(errors='replace').rstrip('\r')
+                                for start, end in zip(starts[bad], ends[bad])]
+                })
+                block = b''.join(block[start:end + 1] for start, end in zip(starts[~bad], ends[~bad]))
+            chunk = pd.read_csv(io.BytesIO(block), header=None, names=columns, dtype=str) if block else \
+                pd.DataFrame(columns=columns, dtype=str)
+            chunk.index = pd.Index(np.flatnonzero(~bad) + row, dtype='int64')
+            chunk.attrs['bad_lines'] = bad_lines
+            row += len(counts)
+            yield chunk
+
+
+def read_csv_chunks(path, chunksize=CHUNK_SIZE, skiprows=0):
+    """Read a customer CSV in typed chunks, skipping already loaded rows"""
+    for chunk in read_raw_chunks(path, chunksize, skiprows):
+        typed, _ = convert_chunk(chunk)
+        yield typed
+
+
+def put_until_stopped(stage_queue, item, stop):
+    """Put an item in a bounded queue unless the pipeline was stopped"""
+    while not stop.is_set():
+        try:
+            stage_queue.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def get_until_stopped(stage_queue, stop):
+    """Get an item from a queue, or PIPELINE_DONE if the pipeline was stopped"""
+    while not stop.is_set():
+        try:
+            return stage_queue.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return PIPELINE_DONE
+
+
+def run_pipeline(source, convert, write, queue_size=QUEUE_SIZE):
+    """Run the read, convert and write stages joined by bounded queues
+
+    Reading and converting run on their own threads while the caller's
+    thread writes, so parsing overlaps with database time. A full queue
+    blocks the stage before it. write() returns the number of rows it
+    handled. Returns the rows and busy seconds of every stage.
+    """
+    stats = {stage: {"rows": 0, "busy": 0.0} for stage in ("read", "convert", "write")}
+    raw_chunks = queue.Queue(maxsize=queue_size)
+    typed_chunks = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def reader():
+        try:
+            chunks = iter(source)
+            while not stop.is_set():
+                start = time.perf_counter()
+                chunk = next(chunks, PIPELINE_DONE)
+                stats["read"]["busy"] += time.perf_counter() - start
+                if chunk is PIPELINE_DONE:
+                    break
+                stats["read"]["rows"] += len(chunk)
+                put_until_stopped(raw_chunks, chunk, stop)
+        except Exception as error:
+            errors.append(error)
+            stop.set()
+        put_until_stopped(raw_chunks, PIPELINE_DONE, stop)
+
+    def converter():
+        try:
+            while True:
+                chunk = get_until_stopped(raw_chunks, stop)
+                if chunk is PIPELINE_DONE:
+                    break
+                start = time.perf_counter()
+                rows = len(chunk)
+                chunk = convert(chunk)
+                stats["convert"]["busy"] += time.perf_counter() - start
+                stats["convert"]["rows"] += rows
+                put_until_stopped(typed_chunks, chunk, stop)
+        except Exception as error:
+            errors.append(error)
+            stop.set()
+        put_until_stopped(typed_chunks, PIPELINE_DONE, stop)
+
+    threads = [threading.Thread(target=reader), threading.Thread(target=converter)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            chunk = get_until_stopped(typed_chunks, stop)
+            if chunk is PIPELINE_DONE:
+                break
+            start = time.perf_counter()
+            rows = write(chunk)
+            stats["write"]["busy"] += time.perf_counter() - start
+            stats["write"]["rows"] += rows
+    except Exception:
+        stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return stats
+
+
+def print_pipeline_stats(stats, elapsed_time):
+    """Print the throughput of every pipeline stage"""
+    bottleneck = max(stats, key=lambda stage: stats[stage]["busy"])
+    for stage, stage_stats in stats.items():
+        rate = stage_stats["rows"] / max(stage_stats["busy"], 1e-9)
+        mark = " <- bottleneck" if stage == bottleneck else ""
+        print(f"  {stage:<8} {stage_stats['rows']:>10} rows  busy {stage_stats['busy']:>7.2f} secs  "
+              f"{rate:>10.0f} rows/sec{mark}")
+    print(f"  {'total':<8} wall {elapsed_time:.2f} secs")
+
+
+def staging_name(tableName):
+    """Name of the staging table a load writes into"""
+    return f"{tableName}_staging"
+
+
+def create_staging(engine, tableName):
+    """Create the UNLOGGED staging table of a load"""
+    columns = [sqlalchemy.Column(name, data_type) for name, data_type in DATA_TYPES.items()]
+    staging = Table(staging_name(tableName), MetaData(), *columns, prefixes=['UNLOGGED'])
+    staging.create(engine, checkfirst=True)
+
+
+def partition_of(connection, tableName):
+    """Get the parent and bound of a table attached as a partition, or None"""
+    return connection.exec_driver_sql(sql_partition_of, {"table": tableName}).first()
+
+
+def swap_staging(engine, tableName, path):
+    """Index, log and analyze the staging table, then swap it into place
+
+    The manifest is marked as loaded in the same short transaction as the
+    rename, so readers only ever see the previous table or the full new one.
+    A table attached as a partition is detached, replaced and the staging
+    table attached in its place, checked beforehand against the bound so
+    the attach doesn't scan it.
+    """
+    staging = staging_name(tableName)
+    with engine.begin() as connection:
+        connection.execute(text(sql_finalize_staging.format(staging=staging)))
+        partition = partition_of(connection, tableName)
+        if partition is not None:
+            parent, bound, key = partition
+            range_bound, range_key = RANGE_BOUND.fullmatch(bound), RANGE_KEY.fullmatch(key)
+            if range_bound and range_key:
+                connection.exec_driver_sql(sql_partition_check.format(
+                    staging=staging, key=range_key.group(1), start=range_bound.group(1), end=range_bound.group(2)))
+    with engine.begin() as connection:
+        if partition is None:
+            connection.execute(text(sql_swap_staging.format(staging=staging, table=tableName)))
+        else:
+            connection.exec_driver_sql(sql_swap_partition.format(
+                staging=staging, table=tableName, parent=partition[0], bound=partition[1]))
+        connection.execute(text(sql_finish_manifest), {
+            "file_path": os.path.realpath(path),
+            "file_mtime": os.stat(path).st_mtime
+        })
+
+
+def file_hash(path):
+    """Hash the content of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def create_manifest(engine):
+    """Create the ingestion manifest and quarantine tables"""
+    with engine.begin() as connection:
+        connection.execute(text(sql_create_manifest))
+        connection.execute(text(sql_create_quarantine))
+
+
+def quarantine_rows(rejected, path, connection):
+    """Store rejected rows with their source file, line and reason"""
+    rejected = rejected.assign(source_file=os.path.realpath(path))
+    rejected.to_sql('ingestion_quarantine', connection, if_exists='append', index=False)
+
+
+def start_manifest(engine, path, tableName):
+    """Check the manifest entry of a file before loading it
+
+    Returns None when the file is already loaded, otherwise the number of
+    rows to skip: the checkpoint of an interrupted load of the same file,
+    or 0 after dropping a stale or half-loaded staging table. The staging
+    table is UNLOGGED and emptied by crash recovery, so a load is only
+    resumed when its row count still matches the checkpoint.
+    """
+    staging = staging_name(tableName)
+    file_path = os.path.realpath(path)
+    stat = os.stat(path)
+    with engine.begin() as connection:
+        entry = connection.execute(text(sql_get_manifest), {"file_path": file_path}).mappings().first()
+
+    unchanged = entry is not None and entry['file_size'] == stat.st_size
+    if unchanged and entry['status'] == 'loaded' and entry['file_mtime'] == stat.st_mtime:
+        return None
+
+    content_hash = file_hash(path)
+    unchanged = unchanged and entry['content_hash'] == content_hash
+    with engine.begin() as connection:
+        if unchanged and entry['status'] == 'loaded':
+            connection.execute(text(sql_finish_manifest), {"file_path": file_path, "file_mtime": stat.st_mtime})
+            return None
+
+        resume_rows = 0
+        if unchanged and sqlalchemy.inspect(connection).has_table(staging):
+            staged = connection.execute(text(f'SELECT COUNT(*) FROM "{staging}"')).scalar()
+            expected = connection.execute(text(sql_checkpoint_rows), {"file_path": file_path}).scalar()
+            if staged == expected:
+                resume_rows = entry['row_count']
+            else:
+                print(f"{staging} has {staged} rows instead of {expected}, loading {path} again")
+        if resume_rows == 0:
+            connection.execute(text(f'DROP TABLE IF EXISTS "{staging}"'))
+            connection.execute(text(sql_clear_quarantine), {"file_path": file_path})
+
+        connection.execute(text(sql_start_manifest), {
+            "file_path": file_path,
+            "table_name": tableName,
+            "file_size": stat.st_size,
+            "file_mtime": stat.st_mtime,
+            "content_hash": content_hash,
+            "row_count": resume_rows
+        })
+    return resume_rows
+
+
+def write_chunk(chunk, tableName, engine):
+    """Append a typed chunk to a table"""
+    chunk = chunk.assign(user_session=session_to_text(chunk['user_session']))
+    chunk.to_sql(tableName, engine, if_exists='append', index=False, dtype=DATA_TYPES)
+
+
+def write_chunk_copy(chunk, tableName, connection):
+    """Append a typed chunk to a table with a text COPY"""
+    chunk = chunk.assign(user_session=session_to_text(chunk['user_session']))
+    buffer = io.StringIO()
+    chunk.to_csv(buffer, index=False, header=False, date_format='%Y-%m-%d %H:%M:%S')
+    buffer.seek(0)
+    columns = ", ".join(f'"{column}"' for column in chunk.columns)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(f'COPY "{tableName}" ({columns}) FROM STDIN WITH (FORMAT csv)', buffer)
+    cursor.close()
+
+
+def binary_field(values, kind):
+    """Encode a column as binary COPY field lengths and data
+
+    Fixed width types return an (n, width) byte array, text returns the
+    categorical codes and the encoded categories.
+    """
+    missing = values.isna().to_numpy()
+    if kind == 'text':
+        categorical = values.astype('category')
+        categories = [category.encode() for category in categorical.cat.categories]
+        codes = categorical.cat.codes.to_numpy()
+        sizes = np.array([len(category) for category in categories] + [0], dtype=np.int64)
+        lengths = np.where(missing, -1, sizes[codes])
+        return lengths, (codes, categories)
+
+    if kind == 'timestamp':
+        micros = values.to_numpy(dtype='datetime64[us]') - POSTGRES_EPOCH
+        data = micros.astype(np.int64).astype('>i8')
+    elif kind == 'uuid':
+        data = np.asarray(values.where(~missing, b''), dtype='S16')
+    else:
+        data = values.fillna(0).to_numpy().astype(BINARY_NUMPY_TYPES[kind])
+    data = data.view(np.uint8).reshape(len(values), -1)
+    lengths = np.where(missing, -1, data.shape[1])
+    return lengths, data
+
+
+def scatter(body, starts, data):
+    """Copy the rows of a byte array into the body at every start offset"""
+    if len(starts):
+        body[starts[:, None] + np.arange(data.shape[1])] = data
+
+
+def encode_binary_copy(chunk):
+    """Encode a typed chunk in the PostgreSQL binary COPY format
+
+    Rows are laid out with numpy: the offset of every field is computed
+    from the field lengths and the columns are scattered into one buffer,
+    so no Python code runs per row.
+    """
+    rows = len(chunk)
+    fields = [binary_field(chunk[column], kind) for column, kind in BINARY_COLUMNS.items()]
+
+    row_sizes = np.full(rows, 2, dtype=np.int64)
+    for lengths, _ in fields:
+        row_sizes += 4 + np.maximum(lengths, 0)
+    starts = np.zeros(rows, dtype=np.int64)
+    np.cumsum(row_sizes[:-1], out=starts[1:])
+
+    body = np.zeros(int(row_sizes.sum()), dtype=np.uint8)
+    field_count = np.array([len(fields)], dtype='>i2').view(np.uint8)
+    scatter(body, starts, np.broadcast_to(field_count, (rows, 2)))
+    position = starts + 2
+
+    for lengths, data in fields:
+        scatter(body, position, lengths.astype('>i4').view(np.uint8).reshape(rows, 4))
+        position += 4
+        present = lengths >= 0
+        if isinstance(data, tuple):
+            codes, categories = data
+            for code, category in enumerate(categories):
+                rows_with_code = present & (codes == code)
+                scatter(body, position[rows_with_code], np.frombuffer(category, dtype=np.uint8)[None, :])
+        else:
+            scatter(body, position[present], data[present])
+        position += np.maximum(lengths, 0)
+
+    return BINARY_COPY_HEADER + body.tobytes() + BINARY_COPY_TRAILER
+
+
+def write_chunk_binary(chunk, tableName, connection):
+    """Append a typed chunk to a table with a binary COPY"""
+    columns = ", ".join(f'"{column}"' for column in BINARY_COLUMNS)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(f'COPY "{tableName}" ({columns}) FROM STDIN WITH (FORMAT binary)',
+                       io.BytesIO(encode_binary_copy(chunk)))
+    cursor.close()
+
+
+WRITERS = {
+    "to_sql": write_chunk,
+    "copy": write_chunk_copy,
+    "binary": write_chunk_binary
+}
+
+
+def load(path, tableName, engine=None, chunksize=CHUNK_SIZE):
     """Load CSV data into a table in the database"""
     print(f"Loading {path} into {tableName} table")
     try:
-        DATABASE_URL = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
-
-        engine = create_engine(DATABASE_URL)
-        inspector = sqlalchemy.inspect(engine)
-        
-        if inspector.has_table(tableName):
-            print(f"Table {tableName} already exists")
+        if engine is None:
+            engine = get_engine()
+        create_manifest(engine)
+        resume_rows = start_manifest(engine, path, tableName)
+        if resume_rows is None:
+            print(f"{path} already loaded into {tableName}")
         else:
-            print(f"Table {tableName} doesn't exist, creating...")
-            data = pd.read_csv(path)
-            data_types = {
-                "event_time": sqlalchemy.DateTime(),
-                "event_type": sqlalchemy.types.String(length=255),
-                "product_id": sqlalchemy.types.Integer(),
-                "price": sqlalchemy.types.Float(),
-                "user_id": sqlalchemy.types.BigInteger(),
-                "user_session": sqlalchemy.types.UUID(as_uuid=True)
-            }
-            data.to_sql(tableName, engine, index=False, dtype=data_types)
-            print(f"Table {tableName} created")
-
-        engine.dispose()
+            print(f"Loading {tableName} from row {resume_rows}...")
+            staging = staging_name(tableName)
+            create_staging(engine, tableName)
+
+            def write(converted):
+                typed, rejected = converted
+                with engine.begin() as connection:
+                    if len(typed):
+                        WRITERS[LOAD_WRITER](typed, staging, connection)
+                    if len(rejected):
+                        quarantine_rows(rejected, path, connection)
+                    connection.execute(text(sql_checkpoint_manifest), {
+                        "file_path": os.path.realpath(path),
+                        "rows": len(typed) + len(rejected)
+                    })
+                return len(typed) + len(rejected)
+
+            metrics_connection = engine.raw_connection()
+            try:
+                with measure(f"load {tableName}", metrics_connection, file=path, writer=LOAD_WRITER) as record:
+                    start = time.time()
+                    stats = run_pipeline(read_raw_chunks(path, chunksize, resume_rows), convert_chunk, write)
+                    print_pipeline_stats(stats, time.time() - start)
+                    swap_staging(engine, tableName, path)
+                    record["rows"] = stats["write"]["rows"]
+            finally:
+                metrics_connection.close()
+            print(f"Table {tableName} loaded")
     except Exception as error:
         print(f"An error occurred: {error}")
 
 
+def load_worker(path, tableName):
+    """Load a CSV from a worker process and return how long it took"""
+    start = time.time()
+    load(path, tableName)
+    return tableName, time.time() - start
+
+
+def load_parallel(files: list, names: list, workers: int = LOAD_WORKERS):
+    """Load the CSV files at the same time, one connection per worker"""
+    jobs = [(file, name) for file, name in zip(files, names) if is_csv_file(file)]
+
+    create_manifest(get_engine())
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(load_worker, file, name) for file, name in jobs]
+        with tqdm(total=len(futures), unit='file') as progress:
+            for future in as_completed(futures):
+                table_name, elapsed_time = future.result()
+                progress.write(f"{table_name} done in {elapsed_time:.2f} secs")
+                progress.update(1)
+
+
+def is_csv_file(file: str) -> bool:
+    """Check if a file is a plain or compressed CSV"""
+    return file.endswith(CSV_EXTENSIONS)
+
+
 def get_folder_files(folder: str) -> list:
     """Get the files in a folder"""
     files = os.listdir(folder)
@@ -64,7 +763,14 @@ def get_folder_files(folder: str) -> list:
 
 def get_file_names(files: list) -> list:
     """Get the names of the files"""
-    names = [file.replace('../subject/customer/', '').replace('.csv', '') for file in files]
+    names = []
+    for file in files:
+        name = os.path.basename(file)
+        for extension in CSV_EXTENSIONS:
+            if name.endswith(extension):
+                name = name[:-len(extension)]
+                break
+        names.append(name)
     return(names)
 
 
@@ -78,11 +784,14 @@ if __name__ == "__main__":
         folder = "../subject/customer"
         files = get_folder_files(folder)
         names = get_file_names(files)
-        
-        for csv_file, table_name in zip(files, names):
-            if not csv_file.endswith('.csv'):
-                continue
-            load(csv_file, table_name)
+
+        if LOAD_WORKERS > 1:
+            load_parallel(files, names, LOAD_WORKERS)
+        else:
+            for csv_file, table_name in zip(files, names):
+                if not is_csv_file(csv_file):
+                    continue
+                load(csv_file, table_name)
 
         stop_timer = True
         timer_thread.join()
@@ -0,0 +1,83 @@
+import sys
+import time
+import numpy as np
+import pandas as pd
+import sqlalchemy
+from sqlalchemy import MetaData, Table, text
+from automatic_table import (DATA_TYPES, CHUNK_SIZE, encode_binary_copy,
+                             write_chunk, write_chunk_copy, write_chunk_binary)
+from db import get_engine
+
+
+def generate_chunks(rows, chunksize=CHUNK_SIZE):
+    """Yield typed customer chunks covering one month"""
+    rng = np.random.default_rng(42)
+    start = np.datetime64('2022-10-01T00:00:00', 'us')
+    for offset in range(0, rows, chunksize):
+        size = min(chunksize, rows - offset)
+        seconds = np.sort(rng.integers(0, 31 * 24 * 3600, size))
+        yield pd.DataFrame({
+            "event_time": start + seconds.astype('timedelta64[s]'),
+            "event_type": pd.Categorical(rng.choice(['view', 'cart', 'remove_from_cart', 'purchase'], size)),
+            "product_id": rng.integers(3752, 5932595, size, dtype=np.int32),
+            "price": rng.integers(0, 30000, size) / 100,
+            "user_id": rng.integers(10079204, 622090237, size, dtype=np.int64),
+            "user_session": pd.Series(np.frombuffer(rng.bytes(size * 16), dtype='S16'), dtype=object)
+        })
+
+
+def create_bench_table(engine, table_name):
+    """Create an empty table with the loader schema"""
+    columns = [sqlalchemy.Column(name, data_type) for name, data_type in DATA_TYPES.items()]
+    table = Table(table_name, MetaData(), *columns)
+    table.drop(engine, checkfirst=True)
+    table.create(engine)
+    return table
+
+
+def bench_writer(engine, name, writer, rows):
+    """Time a writer over a generated month, one transaction per chunk"""
+    table = create_bench_table(engine, f"bench_{name}")
+    start = time.time()
+    for chunk in generate_chunks(rows):
+        with engine.begin() as connection:
+            writer(chunk, table.name, connection)
+    elapsed_time = time.time() - start
+    table.drop(engine)
+    return elapsed_time
+
+
+def bench_generate(rows):
+    """Time the data generation alone, to subtract it from the writers"""
+    start = time.time()
+    for _ in generate_chunks(rows):
+        pass
+    return time.time() - start
+
+
+def bench_encode(rows):
+    """Time the binary encoding alone"""
+    start = time.time()
+    for chunk in generate_chunks(rows):
+        encode_binary_copy(chunk)
+    return time.time() - start
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    writers = sys.argv[2].split(',') if len(sys.argv) > 2 else ['binary', 'copy', 'to_sql']
+    available = {"to_sql": write_chunk, "copy": write_chunk_copy, "binary": write_chunk_binary}
+
+    engine = get_engine()
+    with engine.connect() as connection:
+        print(connection.execute(text("SELECT version()")).scalar())
+
+    generate_time = bench_generate(rows)
+    print(f"{rows} rows, generation {generate_time:.2f} secs, "
+          f"binary encoding {bench_encode(rows) - generate_time:.2f} secs")
+    print(f"{'writer':<8} {'secs':>8} {'rows/sec':>12}")
+    for name in writers:
+        elapsed_time = bench_writer(engine, name, available[name], rows) - generate_time
+        print(f"{name:<8} {elapsed_time:>8.2f} {rows / elapsed_time:>12.0f}")
+
+    engine.dispose()
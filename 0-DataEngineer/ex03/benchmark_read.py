@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+import tracemalloc
+import tempfile
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from automatic_table import read_csv_chunks, session_to_text, EVENT_TIME_FORMAT
+
+
+def generate_csv(path, rows):
+    """Write a customer CSV with random rows"""
+    rng = np.random.default_rng(42)
+    start = np.datetime64('2022-10-01T00:00:00')
+    event_time = start + np.sort(rng.integers(0, 31 * 24 * 3600, rows)).astype('timedelta64[s]')
+    sessions = pd.Series(np.frombuffer(rng.bytes(rows * 16), dtype='S16'), dtype=object)
+    data = pd.DataFrame({
+        "event_time": pd.Series(event_time).dt.strftime(EVENT_TIME_FORMAT),
+        "event_type": rng.choice(['view', 'cart', 'remove_from_cart', 'purchase'], rows),
+        "product_id": rng.integers(3752, 5932595, rows),
+        "price": rng.integers(0, 30000, rows) / 100,
+        "user_id": rng.integers(10079204, 622090237, rows),
+        "user_session": session_to_text(sessions)
+    })
+    data.to_csv(path, index=False)
+
+
+def read_strptime(path):
+    """Current table_psy path: whole file read, per row strptime"""
+    data = pd.read_csv(path)
+    data['event_time'] = [datetime.strptime(value, EVENT_TIME_FORMAT) for value in data['event_time']]
+    return data
+
+
+def read_strings(path):
+    """Current to_sql path: whole file read, timestamps left as strings"""
+    return pd.read_csv(path)
+
+
+def read_typed(path):
+    """Typed schema with vectorized timestamp parsing"""
+    return pd.concat(read_csv_chunks(path, 1000000), ignore_index=True)
+
+
+def measure(reader, path):
+    """Return the time, DataFrame size and peak allocation of a reader"""
+    start_time = time.time()
+    data = reader(path)
+    elapsed_time = time.time() - start_time
+    frame_bytes = data.memory_usage(deep=True).sum()
+    del data
+
+    tracemalloc.start()
+    reader(path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed_time, frame_bytes, peak
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    path = sys.argv[2] if len(sys.argv) > 2 else None
+
+    with tempfile.TemporaryDirectory() as folder:
+        if path is None:
+            path = os.path.join(folder, 'data_bench.csv')
+            print(f"Generating {rows} rows into {path}")
+            generate_csv(path, rows)
+
+        print(f"{'reader':<10} {'secs':>8} {'frame MB':>10} {'peak MB':>10}")
+        for name, reader in (("strptime", read_strptime), ("strings", read_strings), ("typed", read_typed)):
+            elapsed_time, frame_bytes, peak = measure(reader, path)
+            print(f"{name:<10} {elapsed_time:>8.2f} {frame_bytes / 2**20:>10.1f} {peak / 2**20:>10.1f}")
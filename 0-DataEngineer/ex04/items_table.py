@@ -1,19 +1,67 @@
 import os
+import hashlib
 import pandas as pd
-from dotenv import load_dotenv
-from sqlalchemy import create_engine, MetaData, Table
+from sqlalchemy import MetaData, Table, text
 import sqlalchemy
 import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
-
-load_dotenv(dotenv_path="../.env")
-
-DB_NAME = os.getenv('POSTGRES_DB')
-DB_USER = os.getenv('POSTGRES_USER')
-DB_PASSWORD = os.getenv('POSTGRES_PASSWORD')
-DB_HOST = 'postgres'
-DB_PORT = '5432'
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metrics import measure  # noqa: E402
+from db import get_engine  # noqa: E402
+
+CHUNK_SIZE = int(os.getenv('LOAD_CHUNKSIZE', 100000))
+
+LOAD_WORKERS = int(os.getenv('LOAD_WORKERS', os.cpu_count() or 1))
+
+CSV_EXTENSIONS = ('.csv', '.csv.gz', '.csv.zst')
+
+sql_create_manifest = """
+CREATE TABLE IF NOT EXISTS ingestion_manifest (
+    file_path TEXT PRIMARY KEY,
+    table_name TEXT NOT NULL,
+    file_size BIGINT NOT NULL,
+    file_mtime DOUBLE PRECISION NOT NULL,
+    content_hash TEXT NOT NULL,
+    row_count BIGINT NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    loaded_at TIMESTAMP
+);
+"""
+
+sql_get_manifest = """
+SELECT file_size, file_mtime, content_hash, row_count, status
+FROM ingestion_manifest
+WHERE file_path = :file_path;
+"""
+
+sql_start_manifest = """
+INSERT INTO ingestion_manifest
+    (file_path, table_name, file_size, file_mtime, content_hash, row_count, status)
+VALUES
+    (:file_path, :table_name, :file_size, :file_mtime, :content_hash, :row_count, 'loading')
+ON CONFLICT (file_path) DO UPDATE SET
+    table_name = EXCLUDED.table_name,
+    file_size = EXCLUDED.file_size,
+    file_mtime = EXCLUDED.file_mtime,
+    content_hash = EXCLUDED.content_hash,
+    row_count = EXCLUDED.row_count,
+    status = 'loading',
+    loaded_at = NULL;
+"""
+
+sql_checkpoint_manifest = """
+UPDATE ingestion_manifest SET row_count = row_count + :rows WHERE file_path = :file_path;
+"""
+
+sql_finish_manifest = """
+UPDATE ingestion_manifest
+SET status = 'loaded', file_mtime = :file_mtime, loaded_at = now()
+WHERE file_path = :file_path;
+"""
 
 
 def start_timer():
@@ -26,34 +74,137 @@ def start_timer():
         time.sleep(1)
 
 
-def load(path, tableName):
+def file_hash(path):
+    """Hash the content of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def create_manifest(engine):
+    """Create the ingestion manifest table"""
+    with engine.begin() as connection:
+        connection.execute(text(sql_create_manifest))
+
+
+def start_manifest(engine, path, tableName):
+    """Check the manifest entry of a file before loading it
+
+    Returns None when the file is already loaded, otherwise the number of
+    rows to skip: the checkpoint of an interrupted load of the same file,
+    or 0 after dropping a stale or half-loaded table.
+    """
+    file_path = os.path.realpath(path)
+    stat = os.stat(path)
+    with engine.begin() as connection:
+        entry = connection.execute(text(sql_get_manifest), {"file_path": file_path}).mappings().first()
+
+    unchanged = entry is not None and entry['file_size'] == stat.st_size
+    if unchanged and entry['status'] == 'loaded' and entry['file_mtime'] == stat.st_mtime:
+        return None
+
+    content_hash = file_hash(path)
+    unchanged = unchanged and entry['content_hash'] == content_hash
+    with engine.begin() as connection:
+        if unchanged and entry['status'] == 'loaded':
+            connection.execute(text(sql_finish_manifest), {"file_path": file_path, "file_mtime": stat.st_mtime})
+            return None
+
+        resume_rows = 0
+        if unchanged and sqlalchemy.inspect(connection).has_table(tableName):
+            resume_rows = entry['row_count']
+        else:
+            connection.execute(text(f'DROP TABLE IF EXISTS "{tableName}"'))
+
+        connection.execute(text(sql_start_manifest), {
+            "file_path": file_path,
+            "table_name": tableName,
+            "file_size": stat.st_size,
+            "file_mtime": stat.st_mtime,
+            "content_hash": content_hash,
+            "row_count": resume_rows
+        })
+    return resume_rows
+
+
+def finish_manifest(engine, path):
+    """Mark a file as fully loaded"""
+    with engine.begin() as connection:
+        connection.execute(text(sql_finish_manifest), {
+            "file_path": os.path.realpath(path),
+            "file_mtime": os.stat(path).st_mtime
+        })
+
+
+def load(path, tableName, engine=None, chunksize=CHUNK_SIZE):
     """Load CSV data into a table in the database"""
     print(f"Loading {path} into {tableName} table")
     try:
-        DATABASE_URL = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
-
-        engine = create_engine(DATABASE_URL)
-        inspector = sqlalchemy.inspect(engine)
-
-        if inspector.has_table(tableName):
-            print(f"Table {tableName} already exists")
+        if engine is None:
+            engine = get_engine()
+        create_manifest(engine)
+        resume_rows = start_manifest(engine, path, tableName)
+        if resume_rows is None:
+            print(f"{path} already loaded into {tableName}")
         else:
-            print(f"Table {tableName} doesn't exist, creating...")
-            data = pd.read_csv(path)
+            print(f"Loading {tableName} from row {resume_rows}...")
             data_types = {
                 "product_id": sqlalchemy.types.Integer(),
                 "category_id": sqlalchemy.types.BigInteger(),
                 "category_code": sqlalchemy.types.String(length=255),
                 "brand": sqlalchemy.types.String(length=255)
             }
-            data.to_sql(tableName, engine, index=False, dtype=data_types)
-            print(f"Table {tableName} created")
-
-        engine.dispose()
+            reader = pd.read_csv(path, chunksize=chunksize, dtype={'category_id': 'Int64'},
+                                 skiprows=range(1, resume_rows + 1))
+            metrics_connection = engine.raw_connection()
+            try:
+                with measure(f"load {tableName}", metrics_connection, file=path) as record:
+                    record["rows"] = 0
+                    for chunk in reader:
+                        with engine.begin() as connection:
+                            chunk.to_sql(tableName, connection, if_exists='append', index=False, dtype=data_types)
+                            connection.execute(text(sql_checkpoint_manifest), {
+                                "file_path": os.path.realpath(path),
+                                "rows": len(chunk)
+                            })
+                        record["rows"] += len(chunk)
+                    finish_manifest(engine, path)
+            finally:
+                metrics_connection.close()
+            print(f"Table {tableName} loaded")
     except Exception as error:
         print(f"An error occurred: {error}")
 
 
+def load_worker(path, tableName):
+    """Load a CSV from a worker process and return how long it took"""
+    start = time.time()
+    load(path, tableName)
+    return tableName, time.time() - start
+
+
+def load_parallel(files: list, names: list, workers: int = LOAD_WORKERS):
+    """Load the CSV files at the same time, one connection per worker"""
+    jobs = [(file, name) for file, name in zip(files, names) if is_csv_file(file)]
+
+    create_manifest(get_engine())
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(load_worker, file, name) for file, name in jobs]
+        with tqdm(total=len(futures), unit='file') as progress:
+            for future in as_completed(futures):
+                table_name, elapsed_time = future.result()
+                progress.write(f"{table_name} done in {elapsed_time:.2f} secs")
+                progress.update(1)
+
+
+def is_csv_file(file: str) -> bool:
+    """Check if a file is a plain or compressed CSV"""
+    return file.endswith(CSV_EXTENSIONS)
+
+
 def get_folder_files(folder: str) -> list:
     """Get the files in a folder"""
     files = os.listdir(folder)
@@ -63,7 +214,14 @@ def get_folder_files(folder: str) -> list:
 
 def get_file_names(files: list) -> list:
     """Get the names of the files"""
-    names = [file.replace('../subject/item/', '').replace('.csv', '') for file in files]
+    names = []
+    for file in files:
+        name = os.path.basename(file)
+        for extension in CSV_EXTENSIONS:
+            if name.endswith(extension):
+                name = name[:-len(extension)]
+                break
+        names.append(name)
     return(names)
 
 if __name__ == "__main__":
@@ -76,11 +234,14 @@ if __name__ == "__main__":
         folder = "../subject/item"
         files = get_folder_files(folder)
         names = get_file_names(files)
-        
-        for csv_file, table_name in zip(files, names):
-            if not csv_file.endswith('.csv'):
-                continue
-            load(csv_file, table_name)
+
+        if LOAD_WORKERS > 1:
+            load_parallel(files, names, LOAD_WORKERS)
+        else:
+            for csv_file, table_name in zip(files, names):
+                if not is_csv_file(csv_file):
+                    continue
+                load(csv_file, table_name)
 
         stop_timer = True
         timer_thread.join()
@@ -0,0 +1,131 @@
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
+import psycopg2
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import json
+import os
+import resource
+import threading
+import time
+
+METRICS_FILE = os.getenv('METRICS_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metrics.jsonl'))
+
+#cluster wide io and temp file counters, bytes read are relation reads, written are writes and extends
+sql_io_counters = """
+SELECT
+    (SELECT COALESCE(SUM(read_bytes), 0) FROM pg_stat_io) AS bytes_read,
+    (SELECT COALESCE(SUM(write_bytes), 0) + COALESCE(SUM(extend_bytes), 0) FROM pg_stat_io) AS bytes_written,
+    (SELECT temp_bytes FROM pg_stat_database WHERE datname = current_database()) AS temp_bytes;
+"""
+
+#postgres 16 and 17 count io operations of op_bytes each, 18 counts the bytes
+sql_io_counters_op_bytes = """
+SELECT
+    (SELECT COALESCE(SUM(reads * op_bytes), 0) FROM pg_stat_io) AS bytes_read,
+    (SELECT COALESCE(SUM((writes + extends) * op_bytes), 0) FROM pg_stat_io) AS bytes_written,
+    (SELECT temp_bytes FROM pg_stat_database WHERE datname = current_database()) AS temp_bytes;
+"""
+
+#before postgres 16 there is no pg_stat_io, only the reads of the database are known
+sql_io_counters_legacy = """
+SELECT
+    blks_read * current_setting('block_size')::bigint AS bytes_read,
+    temp_bytes
+FROM pg_stat_database WHERE datname = current_database();
+"""
+
+write_lock = threading.Lock()
+
+
+def io_counters_query(server_version: int) -> str:
+    """Pick the io counters query of a server version"""
+    if server_version >= 180000:
+        return sql_io_counters
+    if server_version >= 160000:
+        return sql_io_counters_op_bytes
+    return sql_io_counters_legacy
+
+
+def io_counters(conn) -> dict:
+    """Read the io counters, or an empty dict when they can't be read
+
+    A transaction opened only for the read is ended right away. Inside one
+    already running on conn the read goes in a savepoint, so a failing read
+    never aborts the caller's transaction; an aborted one isn't read at all.
+    """
+    if conn is None:
+        return {}
+    status = conn.get_transaction_status()
+    if status not in (TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS):
+        return {}
+    idle = status == TRANSACTION_STATUS_IDLE
+    counters = {}
+    try:
+        with conn.cursor() as cursor:
+            if not idle:
+                cursor.execute("SAVEPOINT metrics_io")
+            try:
+                cursor.execute("SELECT pg_stat_clear_snapshot()")
+                cursor.execute(io_counters_query(conn.server_version))
+                names = [column.name for column in cursor.description]
+                counters = dict(zip(names, (int(value) for value in cursor.fetchone())))
+            except psycopg2.Error:
+                if not idle:
+                    cursor.execute("ROLLBACK TO SAVEPOINT metrics_io")
+            if not idle:
+                cursor.execute("RELEASE SAVEPOINT metrics_io")
+    finally:
+        if idle:
+            conn.rollback()
+    return counters
+
+
+def safe_io_counters(conn) -> dict:
+    """Read the io counters, never failing the measured work"""
+    try:
+        return io_counters(conn)
+    except Exception:
+        return {}
+
+
+def write_record(record: dict):
+    """Append a record to the metrics file as one JSON line"""
+    with write_lock, open(METRICS_FILE, 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+
+
+@contextmanager
+def measure(step: str, conn=None, **fields):
+    """Record the wall time, rows, io and peak client RSS of a block
+
+    The block can set record['rows']. The io counters are read on conn
+    before and after the block; they are cluster wide and Postgres flushes
+    them about every second, so concurrent work and very short blocks blur
+    them.
+    """
+    record = {"step": step, "started_at": datetime.now(timezone.utc).isoformat(), "rows": None, **fields}
+    before = safe_io_counters(conn)
+    start_time = time.time()
+    try:
+        yield record
+        record["status"] = "ok"
+    except Exception as error:
+        record["status"] = "error"
+        record["error"] = str(error)
+        raise
+    finally:
+        record["wall_secs"] = round(time.time() - start_time, 3)
+        if record["rows"] is not None and record["wall_secs"] > 0:
+            record["rows_per_sec"] = round(record["rows"] / record["wall_secs"], 1)
+        after = safe_io_counters(conn)
+        record.update({name: after[name] - before[name] for name in after if name in before})
+        record["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        write_record(record)
+
+
+def execute(cursor, query, params=None, step: str = None):
+    """Execute a statement and record its metrics with its affected rows"""
+    with measure(step or query.strip().splitlines()[0][:80], cursor.connection) as record:
+        cursor.execute(query, params)
+        record["rows"] = cursor.rowcount if cursor.rowcount >= 0 else None
+    return cursor
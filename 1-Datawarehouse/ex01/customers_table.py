@@ -1,16 +1,18 @@
 import psycopg2
-from dotenv import load_dotenv
+from psycopg2 import sql
 import os
 import time
+import sys
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metrics import execute  # noqa: E402
+from db import get_connection, release_connection  # noqa: E402
 
-load_dotenv(dotenv_path="../.env")
 
-DB_NAME = os.getenv('POSTGRES_DB')
-DB_USER = os.getenv('POSTGRES_USER')
-DB_PASSWORD = os.getenv('POSTGRES_PASSWORD')
-DB_HOST = 'postgres'
-DB_PORT = '5432'
+CUSTOMERS_TABLE = os.getenv('CUSTOMERS_TABLE', 'customers_2')
+CUSTOMERS_MODE = os.getenv('CUSTOMERS_MODE', 'partitioned')
+
+MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
 
 sql_join = """
 CREATE TABLE IF NOT EXISTS customers_2 AS (
@@ -27,24 +29,219 @@ CREATE TABLE IF NOT EXISTS customers_2 AS (
 """
 
 
+sql_monthly_tables = """
+SELECT table_name
+FROM information_schema.tables
+WHERE table_schema = 'public'
+  AND table_type = 'BASE TABLE'
+  AND table_name ~ '^data_[0-9]{4}_(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)$';
+"""
+
+sql_is_partitioned = """
+SELECT EXISTS (
+    SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid
+    WHERE c.relname = %s
+), to_regclass(%s) IS NOT NULL;
+"""
+
+sql_attached_partitions = """
+SELECT c.relname
+FROM pg_inherits i
+JOIN pg_class c ON c.oid = i.inhrelid
+JOIN pg_class p ON p.oid = i.inhparent
+WHERE p.relname = %s;
+"""
+
+sql_create_sources = """
+CREATE TABLE IF NOT EXISTS customers_sources (
+    target_table TEXT NOT NULL,
+    source_table TEXT NOT NULL,
+    row_count BIGINT NOT NULL,
+    appended_at TIMESTAMP NOT NULL DEFAULT now(),
+    PRIMARY KEY (target_table, source_table)
+);
+"""
+
+sql_appended_sources = """
+SELECT source_table FROM customers_sources WHERE target_table = %s;
+"""
+
+#rows the loader wrote to a monthly table, its loaded rows minus the quarantined ones
+sql_loaded_rows = """
+SELECT m.row_count - (SELECT COUNT(*) FROM ingestion_quarantine q WHERE q.source_file = m.file_path)
+FROM ingestion_manifest m
+WHERE m.table_name = %s AND m.status = 'loaded'
+ORDER BY m.loaded_at DESC
+LIMIT 1;
+"""
+
+sql_has_manifest = """
+SELECT to_regclass('ingestion_manifest') IS NOT NULL AND to_regclass('ingestion_quarantine') IS NOT NULL;
+"""
+
+sql_record_source = """
+INSERT INTO customers_sources (target_table, source_table, row_count) VALUES (%s, %s, %s);
+"""
+
+
+def month_range(table_name: str) -> tuple:
+    """Get the first day of the month of a data_YYYY_mon table and of the next one"""
+    _, year, month = table_name.split('_')
+    year, month = int(year), MONTHS.index(month) + 1
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return f"{year}-{month:02d}-01", f"{next_year}-{next_month:02d}-01"
+
+
+def get_monthly_tables(cursor) -> list:
+    """Get the data_YYYY_mon tables sorted by month"""
+    cursor.execute(sql_monthly_tables)
+    tables = [row[0] for row in cursor.fetchall()]
+    return sorted(tables, key=month_range)
+
+
+def build_partitioned_customers(table_name: str = CUSTOMERS_TABLE):
+    """Build the customers table as a partitioned table over the monthly tables
+
+    Every data_YYYY_mon table not attached yet is attached as the partition
+    of its month, without copying it. Postgres only scans it once to check
+    that its rows belong to the month. A month that can't be attached
+    doesn't stop the others, but the build fails once they are done.
+    """
+    conn = get_connection()
+    print("Connected to postgres!")
+    cursor = conn.cursor()
+
+    try:
+        monthly_tables = get_monthly_tables(cursor)
+        if not monthly_tables:
+            print("No data_YYYY_mon tables found.")
+            return
+
+        cursor.execute(sql_is_partitioned, (table_name, table_name))
+        partitioned, exists = cursor.fetchone()
+        if exists and not partitioned:
+            raise Exception(f"{table_name} exists and is not partitioned, drop it first")
+        if not exists:
+            cursor.execute(sql.SQL("CREATE TABLE {} (LIKE {}) PARTITION BY RANGE (event_time)").format(
+                sql.Identifier(table_name), sql.Identifier(monthly_tables[0])))
+            conn.commit()
+            print(f"Created partitioned table {table_name}.")
+
+        cursor.execute(sql_attached_partitions, (table_name,))
+        attached = {row[0] for row in cursor.fetchall()}
+
+        failed = []
+        for month_table in monthly_tables:
+            if month_table in attached:
+                continue
+            start, end = month_range(month_table)
+            try:
+                execute(cursor, sql.SQL("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)").format(
+                    sql.Identifier(table_name), sql.Identifier(month_table)), (start, end),
+                    step=f"customers attach {month_table}")
+                conn.commit()
+                print(f"Attached {month_table} [{start}, {end}).")
+            except psycopg2.Error as error:
+                conn.rollback()
+                print(f"Could not attach {month_table}: {error}")
+                failed.append(month_table)
+        if failed:
+            raise Exception(f"Could not attach {', '.join(failed)} to {table_name}")
+
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+
+def append_new_months(table_name: str = CUSTOMERS_TABLE):
+    """Append to the customers table only the monthly tables it doesn't have yet
+
+    customers_sources records which monthly tables are already in the
+    table. Every new month is copied in its own transaction, and the rows
+    inserted must match the rows the loader recorded in ingestion_manifest
+    before it is recorded. Months loaded without the manifest aren't checked.
+    """
+    conn = get_connection()
+    conn.set_session(isolation_level='REPEATABLE READ')
+    print("Connected to postgres!")
+    cursor = conn.cursor()
+
+    try:
+        monthly_tables = get_monthly_tables(cursor)
+        if not monthly_tables:
+            print("No data_YYYY_mon tables found.")
+            return
+
+        cursor.execute(sql_is_partitioned, (table_name, table_name))
+        partitioned, exists = cursor.fetchone()
+        if partitioned:
+            raise Exception(f"{table_name} is partitioned, use the partitioned mode")
+        cursor.execute(sql_create_sources)
+        cursor.execute(sql_appended_sources, (table_name,))
+        appended = {row[0] for row in cursor.fetchall()}
+        cursor.execute(sql_has_manifest)
+        has_manifest = cursor.fetchone()[0]
+
+        if not exists:
+            cursor.execute(sql.SQL("CREATE TABLE {} (LIKE {})").format(
+                sql.Identifier(table_name), sql.Identifier(monthly_tables[0])))
+        elif not appended:
+            cursor.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {})").format(sql.Identifier(table_name)))
+            if cursor.fetchone()[0]:
+                raise Exception(f"{table_name} was built without customers_sources, drop it first")
+        conn.commit()
+
+        for month_table in monthly_tables:
+            if month_table in appended:
+                continue
+            expected = None
+            if has_manifest:
+                cursor.execute(sql_loaded_rows, (month_table,))
+                row = cursor.fetchone()
+                expected = row[0] if row else None
+            execute(cursor, sql.SQL("INSERT INTO {} SELECT * FROM {}").format(
+                sql.Identifier(table_name), sql.Identifier(month_table)), step=f"customers append {month_table}")
+            inserted = cursor.rowcount
+            if expected is None:
+                print(f"{month_table} has no loaded ingestion_manifest entry, {inserted} rows not verified.")
+            elif inserted != expected:
+                conn.rollback()
+                raise Exception(f"{month_table}: inserted {inserted} rows, expected {expected}")
+            cursor.execute(sql_record_source, (table_name, month_table, inserted))
+            conn.commit()
+            print(f"Appended {month_table} ({inserted} rows).")
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+
 def join_tables():
     """Join the tables"""
     
-    conn = psycopg2.connect(
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        host=DB_HOST,
-        port=DB_PORT
-    )
+    conn = get_connection()
     print("Connected to postgres!")
     cursor = conn.cursor()
-    cursor.execute(sql_join)
+    execute(cursor, sql_join, step="customers join")
     print("Data has been fetched from the table.")
     conn.commit()
 
     cursor.close()
-    conn.close()
+    release_connection(conn)
+
+
+def build_customers():
+    """Build the customers table with the CUSTOMERS_MODE strategy"""
+    if CUSTOMERS_MODE == 'partitioned':
+        build_partitioned_customers()
+    elif CUSTOMERS_MODE == 'incremental':
+        append_new_months()
+    else:
+        join_tables()
 
 
 if __name__ == "__main__":
@@ -52,7 +249,7 @@ if __name__ == "__main__":
     start_time = time.time()
 
     try:
-        join_tables()
+        build_customers()
     
     except Exception as error:
         print(f"An error occurred: {error}")
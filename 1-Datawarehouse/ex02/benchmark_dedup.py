@@ -0,0 +1,84 @@
+import sys
+import time
+import resource
+import multiprocessing
+import queue
+from remove_duplicates import clean_customers_sql, clean_customers_stream, clean_customers_parallel
+from db import get_connection, release_connection
+
+
+sql_database_stats = """
+SELECT temp_bytes, temp_files, blks_read FROM pg_stat_database WHERE datname = current_database();
+"""
+
+
+def database_stats(conn):
+    """Read the temp file and block counters of the database"""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_stat_clear_snapshot()")
+        cursor.execute(sql_database_stats)
+        stats = cursor.fetchone()
+    conn.commit()
+    return stats
+
+
+def run_engine(engine, output, results):
+    """Run one engine in its own process so its peak RSS is its own
+
+    Puts the measures on results, or the error the engine raised. The
+    output table is dropped either way.
+    """
+    conn = get_connection()
+    try:
+        before = database_stats(conn)
+        start = time.time()
+        rows = engine(conn, output)
+        elapsed_time = time.time() - start
+        time.sleep(1)
+        after = database_stats(conn)
+        results.put((rows, elapsed_time,
+                     after[0] - before[0], after[1] - before[1], after[2] - before[2],
+                     resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    except Exception as error:
+        results.put(Exception(f"{type(error).__name__}: {error}"))
+    finally:
+        conn.rollback()
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {output}")
+        conn.commit()
+        release_connection(conn)
+
+
+def wait_result(process, results):
+    """Wait for the measures of an engine process, or an error if it died without any"""
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            if process.exitcode is not None:
+                try:
+                    return results.get(timeout=1)
+                except queue.Empty:
+                    return Exception(f"engine process exited with code {process.exitcode}")
+
+
+if __name__ == "__main__":
+    engines = sys.argv[1].split(',') if len(sys.argv) > 1 else ['sql', 'stream', 'parallel']
+    available = {"sql": clean_customers_sql, "stream": clean_customers_stream,
+                 "parallel": clean_customers_parallel}
+
+    print(f"{'engine':<8} {'rows':>12} {'secs':>8} {'temp MB':>10} {'temp files':>10} "
+          f"{'blks read':>12} {'client RSS MB':>14}")
+    for name in engines:
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_engine,
+                                          args=(available[name], f"bench_dedup_{name}", results))
+        process.start()
+        result = wait_result(process, results)
+        process.join()
+        if isinstance(result, Exception):
+            print(f"{name:<8} failed: {result}")
+            continue
+        rows, elapsed_time, temp_bytes, temp_files, blks_read, maxrss = result
+        print(f"{name:<8} {rows:>12} {elapsed_time:>8.2f} {temp_bytes / 2**20:>10.1f} {temp_files:>10} "
+              f"{blks_read:>12} {maxrss / 1024:>14.1f}")
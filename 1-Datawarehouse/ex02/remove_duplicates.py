@@ -1,17 +1,26 @@
-import psycopg2
-from dotenv import load_dotenv
+from psycopg2 import sql
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+import csv
+import io
 import os
 import time
+import sys
 
-start_time = time.time()
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metrics import measure, execute  # noqa: E402
+from db import get_connection, release_connection  # noqa: E402
+from slices import default_workers, slice_source, drop_slices  # noqa: E402
 
-load_dotenv(dotenv_path="../.env")
+DEDUP_MODE = os.getenv('DEDUP_MODE', 'sql')
+DEDUP_MAX_KEYS = int(os.getenv('DEDUP_MAX_KEYS', 1000000))
+DEDUP_BATCH_SIZE = int(os.getenv('DEDUP_BATCH_SIZE', 100000))
+DEDUP_WORKERS = int(os.getenv('DEDUP_WORKERS', default_workers()))
+DEDUP_WINDOW_SECONDS = float(os.getenv('DEDUP_WINDOW_SECONDS')) if os.getenv('DEDUP_WINDOW_SECONDS') else None
 
-DB_NAME = os.getenv('POSTGRES_DB')
-DB_USER = os.getenv('POSTGRES_USER')
-DB_PASSWORD = os.getenv('POSTGRES_PASSWORD')
-DB_HOST = 'postgres'
-DB_PORT = '5432'
+CUSTOMER_COLUMNS = ['event_time', 'event_type', 'product_id', 'price', 'user_id', 'user_session']
+KEY_COLUMNS = ['event_type', 'product_id', 'price', 'user_id', 'user_session']
 
 
 #cleans duplicates from the item table
@@ -31,8 +40,8 @@ GROUP BY
 
 #cleans duplicates from the customers table
 sql_clean_customers = """
-DROP TABLE IF EXISTS customers_clean_2;
-CREATE TABLE customers_clean_2 AS
+DROP TABLE IF EXISTS {output};
+CREATE TABLE {output} AS
 WITH ranked_events AS (
   SELECT *,
          ROW_NUMBER() OVER (
@@ -48,30 +57,253 @@ WHERE rn = 1
 ORDER BY event_time;
 """
 
+#drops only rows repeating the key of the previous row within the window
+sql_clean_customers_window = """
+DROP TABLE IF EXISTS {output};
+CREATE TABLE {output} AS
+SELECT
+  event_time, event_type, product_id, price, user_id, user_session
+FROM (
+  SELECT *,
+         LAG(event_time) OVER (
+           PARTITION BY {keys}
+           ORDER BY event_time
+         ) AS previous_time
+  FROM customers_2
+) AS events
+WHERE previous_time IS NULL
+   OR event_time - previous_time > make_interval(secs => {window});
+"""
+
+#one user_id slice of the dedup, every key belongs to a single slice
+sql_slice_customers = """
+INSERT INTO {partition}
+SELECT
+  event_time, event_type, product_id, price, user_id, user_session
+FROM (
+  SELECT *,
+         ROW_NUMBER() OVER (
+           PARTITION BY {keys}
+           ORDER BY event_time
+         ) AS rn
+  FROM {source}
+  WHERE user_id % {slices} = {slice}
+) AS ranked_events
+WHERE rn = 1;
+"""
+
+sql_slice_customers_window = """
+INSERT INTO {partition}
+SELECT
+  event_time, event_type, product_id, price, user_id, user_session
+FROM (
+  SELECT *,
+         LAG(event_time) OVER (
+           PARTITION BY {keys}
+           ORDER BY event_time
+         ) AS previous_time
+  FROM {source}
+  WHERE user_id % {slices} = {slice}
+) AS events
+WHERE previous_time IS NULL
+   OR event_time - previous_time > make_interval(secs => {window});
+"""
+
+sql_create_sliced_output = """
+DROP TABLE IF EXISTS {output};
+CREATE TABLE {output} (LIKE customers_2) PARTITION BY LIST ((user_id % {slices}));
+"""
+
+sql_create_slice_partition = """
+CREATE TABLE {partition} PARTITION OF {output} FOR VALUES IN ({slice});
+"""
+
+sql_event_time_index = """
+CREATE INDEX IF NOT EXISTS customers_2_event_time_idx ON customers_2 (event_time);
+"""
+
+sql_stream_customers = """
+SELECT event_time, event_type, product_id, price, user_id, user_session
+FROM customers_2
+ORDER BY event_time;
+"""
+
+sql_create_stream_output = """
+DROP TABLE IF EXISTS {output};
+CREATE TABLE {output} AS SELECT event_time, event_type, product_id, price, user_id, user_session
+FROM customers_2 WITH NO DATA;
+"""
 
-def remove_duplicates():
-    """Remove duplicates from the item and customers tables"""
 
-    conn = psycopg2.connect(
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        host=DB_HOST,
-        port=DB_PORT
-    )
+def clean_customers_sql(conn, output='customers_clean_2', window=DEDUP_WINDOW_SECONDS):
+    """Keep the first row of every key, or of every burst of it when a window is set
+
+    Without a window the first row of each key over the whole table is kept.
+    With a window in seconds, a row is a duplicate only when the previous row
+    with the same key is at most window seconds older.
+    """
+    if window is None:
+        query = sql_clean_customers.format(output=output)
+    else:
+        query = sql_clean_customers_window.format(output=output, keys=', '.join(KEY_COLUMNS), window=float(window))
+    with conn.cursor() as cursor:
+        execute(cursor, query, step="customers_clean_2 sql")
+        rows = cursor.rowcount
+    conn.commit()
+    return rows
+
+
+def copy_rows(cursor, rows, output):
+    """COPY a batch of row tuples into the output table"""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor.copy_expert(
+        sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+            sql.Identifier(output), sql.SQL(', ').join(map(sql.Identifier, CUSTOMER_COLUMNS))),
+        buffer)
+
+
+def clean_customers_stream(conn, output='customers_clean_2', max_keys=DEDUP_MAX_KEYS,
+                           window=DEDUP_WINDOW_SECONDS):
+    """Stream customers_2 in event_time order and drop keys already seen
+
+    The seen keys are kept in an LRU bounded by max_keys, so a duplicate is
+    only caught while its key is still cached. With a cache larger than the
+    number of distinct keys the result matches clean_customers_sql.
+    With a window, keys older than the window can never match again and are
+    evicted as the stream moves on, so the result is exact while fewer than
+    max_keys keys are seen inside one window.
+    """
+    if window is not None:
+        window = timedelta(seconds=window)
+    with conn.cursor() as cursor:
+        cursor.execute(sql_event_time_index)
+        cursor.execute(sql_create_stream_output.format(output=output))
+    conn.commit()
+
+    seen = OrderedDict()
+    kept = 0
+    with conn.cursor(name='customers_stream') as reader, conn.cursor() as writer:
+        reader.itersize = DEDUP_BATCH_SIZE
+        reader.execute(sql_stream_customers)
+        while True:
+            rows = reader.fetchmany(DEDUP_BATCH_SIZE)
+            if not rows:
+                break
+            survivors = []
+            for row in rows:
+                event_time, key = row[0], row[1:]
+                if window is not None:
+                    while seen and next(iter(seen.values())) < event_time - window:
+                        seen.popitem(last=False)
+                duplicate = key in seen and (window is None or event_time - seen[key] <= window)
+                seen[key] = event_time
+                seen.move_to_end(key)
+                if len(seen) > max_keys:
+                    seen.popitem(last=False)
+                if not duplicate:
+                    survivors.append(row)
+            copy_rows(writer, survivors, output)
+            kept += len(survivors)
+    conn.commit()
+    return kept
+
+
+def clean_customers_slice(output, source, slices, slice_number, window=DEDUP_WINDOW_SECONDS):
+    """Dedup one user_id slice of customers_2 into its partition, on its own connection"""
+    query = sql_slice_customers if window is None else sql_slice_customers_window
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            execute(cursor, query.format(partition=f"{output}_p{slice_number}", keys=', '.join(KEY_COLUMNS),
+                                         source=source, slices=slices, slice=slice_number,
+                                         window=float(window) if window is not None else None),
+                    step=f"customers_clean_2 slice {slice_number}")
+            rows = cursor.rowcount
+        conn.commit()
+        return rows
+    finally:
+        release_connection(conn)
+
+
+def clean_customers_parallel(conn, output='customers_clean_2', workers=DEDUP_WORKERS,
+                             window=DEDUP_WINDOW_SECONDS):
+    """Dedup customers_2 in user_id slices at the same time over several connections
+
+    user_id is part of the dedup key, so every slice is deduplicated on its
+    own and the result matches clean_customers_sql. Each slice is written to
+    its own partition of the output, listed by user_id % workers. The loader
+    rejects rows without a user_id, so every row falls in a slice.
+    customers_2 is split by slice in one pass first, so every slice only
+    reads its own part.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(sql_create_sliced_output.format(output=output, slices=workers))
+        for slice_number in range(workers):
+            cursor.execute(sql_create_slice_partition.format(
+                partition=f"{output}_p{slice_number}", output=output, slice=slice_number))
+        with measure("customers_clean_2 split", conn):
+            source = slice_source(cursor, 'customers_2', workers)
+    conn.commit()
+
+    kept = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(clean_customers_slice, output, source, workers, slice_number, window):
+                       slice_number for slice_number in range(workers)}
+            for future in as_completed(futures):
+                rows = future.result()
+                kept += rows
+                print(f"Slice {futures[future]} cleaned, {rows} rows kept.")
+    finally:
+        conn.rollback()
+        with conn.cursor() as cursor:
+            drop_slices(cursor, 'customers_2')
+        conn.commit()
+    return kept
+
+
+def clean_items():
+    """Remove duplicates from the item table"""
+
+    conn = get_connection()
     print("Connected to postgres!")
     cursor = conn.cursor()
-    cursor.execute(sql_clean_item)
-    actual_time = time.time() - start_time
-    print(f"Items table cleaned. {actual_time} seconds")
-    cursor.execute(sql_clean_customers)
-    actual_time = time.time() - actual_time
-    print(f"Customers table cleaned. {actual_time} seconds")
+    execute(cursor, sql_clean_item, step="item_clean")
     conn.commit()
 
     cursor.close()
-    conn.close()
+    release_connection(conn)
+
+
+def clean_customers():
+    """Remove duplicates from the customers table with the DEDUP_MODE engine"""
+
+    conn = get_connection()
+    print("Connected to postgres!")
+    try:
+        with measure("customers_clean_2", conn, mode=DEDUP_MODE, window=DEDUP_WINDOW_SECONDS) as record:
+            if DEDUP_MODE == 'stream':
+                record["rows"] = clean_customers_stream(conn)
+            elif DEDUP_MODE == 'parallel':
+                record["rows"] = clean_customers_parallel(conn)
+            else:
+                record["rows"] = clean_customers_sql(conn)
+
+    finally:
+        release_connection(conn)
+
+
+def remove_duplicates():
+    """Remove duplicates from the item and customers tables"""
 
+    step_time = time.time()
+    clean_items()
+    print(f"Items table cleaned. {time.time() - step_time} seconds")
+    step_time = time.time()
+    clean_customers()
+    print(f"Customers table cleaned. {time.time() - step_time} seconds")
 
 if __name__ == "__main__":
     try:
@@ -1,15 +1,26 @@
 import psycopg2
-from dotenv import load_dotenv
+from psycopg2 import sql
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+import pandas as pd
+import io
 import os
 import time
+import sys
 
-load_dotenv(dotenv_path="../.env")
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metrics import measure, execute  # noqa: E402
+from db import get_connection, release_connection  # noqa: E402
+from slices import default_workers, slice_source, drop_slices  # noqa: E402
 
-DB_NAME = os.getenv('POSTGRES_DB')
-DB_USER = os.getenv('POSTGRES_USER')
-DB_PASSWORD = os.getenv('POSTGRES_PASSWORD')
-DB_HOST = 'postgres'
-DB_PORT = '5432'
+FUSION_MODE = os.getenv('FUSION_MODE', 'sql')
+FUSION_WORKERS = int(os.getenv('FUSION_WORKERS', default_workers()))
+FUSION_CHUNK_SIZE = int(os.getenv('FUSION_CHUNK_SIZE', 200000))
+FUSION_LOCK_TIMEOUT = os.getenv('FUSION_LOCK_TIMEOUT', '100ms')
+FUSION_SWAP_RETRIES = int(os.getenv('FUSION_SWAP_RETRIES', 20))
+
+CUSTOMER_COLUMNS = ['event_time', 'event_type', 'product_id', 'price', 'user_id', 'user_session']
+ITEM_COLUMNS = ['category_id', 'category_code', 'brand']
 
 sql_fusion = """
 DROP TABLE IF EXISTS new_customers_3;
@@ -32,40 +43,303 @@ ON
     c.product_id = i.product_id;
 """
 
-sql_rename = """
-ALTER TABLE customers RENAME TO old_customers;
-ALTER TABLE new_customers RENAME TO customers;
+sql_create_sliced_fusion = """
+DROP TABLE IF EXISTS new_customers_3;
+CREATE TEMP TABLE fusion_columns AS
+SELECT
+    c.event_time, c.event_type, c.product_id, c.price, c.user_id, c.user_session,
+    i.category_id, i.category_code, i.brand
+FROM customers_clean_2 c JOIN item_clean i ON c.product_id = i.product_id
+WITH NO DATA;
+CREATE TABLE new_customers_3 (LIKE fusion_columns) PARTITION BY LIST ((user_id % {slices}));
+DROP TABLE fusion_columns;
+"""
+
+sql_create_fusion_partition = """
+CREATE TABLE new_customers_3_p{slice} PARTITION OF new_customers_3 FOR VALUES IN ({slice});
+"""
+
+#one user_id slice of the fusion
+sql_fusion_slice = """
+INSERT INTO new_customers_3_p{slice}
+SELECT
+    c.event_time,
+    c.event_type,
+    c.product_id,
+    c.price,
+    c.user_id,
+    c.user_session,
+    i.category_id,
+    i.category_code,
+    i.brand
+FROM
+    {source} c
+JOIN
+    item_clean i
+ON
+    c.product_id = i.product_id
+WHERE
+    c.user_id % {slices} = {slice};
+"""
+
+sql_create_fusion_progress = """
+CREATE TABLE IF NOT EXISTS fusion_progress (
+    slice_start TEXT PRIMARY KEY,
+    rows_written BIGINT NOT NULL,
+    finished_at TIMESTAMP NOT NULL DEFAULT now()
+);
+ALTER TABLE fusion_progress ADD COLUMN IF NOT EXISTS source TEXT;
+"""
+
+#storage of the fusion inputs, a rebuild or truncate of either changes it
+sql_fusion_source = """
+SELECT string_agg(c.relname || ':' || c.oid || ':' || c.relfilenode, ',' ORDER BY c.relname)
+FROM pg_class c
+WHERE c.oid IN ('customers_clean_2'::regclass, 'item_clean'::regclass);
+"""
+
+sql_reset_fusion = """
+DELETE FROM fusion_progress;
+DROP TABLE IF EXISTS new_customers_3;
+CREATE TABLE new_customers_3 AS
+SELECT
+    c.event_time, c.event_type, c.product_id, c.price, c.user_id, c.user_session,
+    i.category_id, i.category_code, i.brand
+FROM customers_clean_2 c JOIN item_clean i ON c.product_id = i.product_id
+WITH NO DATA;
+"""
+
+#the dedup engines build customers_clean_2 without indexes, months are read through this one
+sql_index_fusion_source = """
+CREATE INDEX IF NOT EXISTS customers_clean_2_event_time_idx ON customers_clean_2 (event_time);
+ANALYZE customers_clean_2;
+"""
+
+sql_fusion_slices = """
+SELECT
+    to_char(month, 'YYYY-MM-DD') AS slice_start,
+    to_char(month + interval '1 month', 'YYYY-MM-DD') AS slice_end,
+    (SELECT reltuples::bigint FROM pg_class WHERE oid = 'customers_clean_2'::regclass) AS estimated_rows
+FROM generate_series(
+    (SELECT date_trunc('month', MIN(event_time)) FROM customers_clean_2),
+    (SELECT MAX(event_time) FROM customers_clean_2),
+    interval '1 month'
+) AS month;
+"""
+
+sql_stream_slice = """
+SELECT event_time, event_type, product_id, price, user_id, user_session
+FROM customers_clean_2
+WHERE event_time >= %s AND event_time < %s;
 """
 
+sql_finalize_fusion = """
+CREATE INDEX IF NOT EXISTS new_customers_3_event_time_idx ON new_customers_3 (event_time);
+CREATE INDEX IF NOT EXISTS new_customers_3_user_id_idx ON new_customers_3 (user_id);
+CREATE INDEX IF NOT EXISTS new_customers_3_user_session_idx ON new_customers_3 (user_session);
+ANALYZE new_customers_3;
+"""
+
+#a table with its partitions and the indexes of both
+sql_table_relations = """
+WITH RECURSIVE tree AS (
+    SELECT to_regclass(%s) AS oid
+    UNION ALL
+    SELECT i.inhrelid FROM pg_inherits i JOIN tree ON i.inhparent = tree.oid
+)
+SELECT c.relkind, c.relname
+FROM pg_class c
+WHERE c.oid IN (SELECT oid FROM tree)
+   OR c.oid IN (SELECT indexrelid FROM pg_index WHERE indrelid IN (SELECT oid FROM tree));
+"""
+
+
+def fusion_slice(source, slices, slice_number):
+    """Fuse one user_id slice into its partition, on its own connection"""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            execute(cursor, sql_fusion_slice.format(source=source, slices=slices, slice=slice_number),
+                    step=f"fusion slice {slice_number}")
+            rows = cursor.rowcount
+        conn.commit()
+        return rows
+    finally:
+        release_connection(conn)
+
+
+def parallel_fusion(cursor, workers=FUSION_WORKERS):
+    """Fuse customers_clean_2 and item_clean in user_id slices at the same time
+
+    Every slice runs on its own connection and writes its own partition of
+    new_customers_3, listed by user_id % workers. When customers_clean_2 is
+    partitioned the same way, each slice only reads its partition; otherwise
+    it is split by slice in one pass first.
+    """
+    cursor.execute(sql_create_sliced_fusion.format(slices=workers))
+    for slice_number in range(workers):
+        cursor.execute(sql_create_fusion_partition.format(slice=slice_number))
+    with measure("fusion split", cursor.connection):
+        source = slice_source(cursor, 'customers_clean_2', workers)
+    cursor.connection.commit()
+
+    fused = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(fusion_slice, source, workers, slice_number): slice_number
+                       for slice_number in range(workers)}
+            for future in as_completed(futures):
+                rows = future.result()
+                fused += rows
+                print(f"Slice {futures[future]} fused, {rows} rows.")
+    finally:
+        cursor.connection.rollback()
+        drop_slices(cursor, 'customers_clean_2')
+        cursor.connection.commit()
+    return fused
+
+
+def load_items(cursor) -> pd.DataFrame:
+    """Load item_clean as a DataFrame indexed by product_id"""
+    cursor.execute("SELECT product_id, category_id, category_code, brand FROM item_clean")
+    items = pd.DataFrame(cursor.fetchall(), columns=['product_id'] + ITEM_COLUMNS)
+    items['category_id'] = items['category_id'].astype('Int64')
+    items['category_code'] = items['category_code'].astype('category')
+    items['brand'] = items['brand'].astype('category')
+    return items.set_index('product_id')
+
+
+def enrich_chunk(chunk: pd.DataFrame, items: pd.DataFrame) -> pd.DataFrame:
+    """Add the item columns to a customers chunk, dropping unknown products like the join"""
+    positions = items.index.get_indexer(chunk['product_id'])
+    found = positions >= 0
+    return chunk[found].assign(**{column: items[column].array.take(positions[found])
+                                  for column in ITEM_COLUMNS})
+
+
+def stream_fusion(conn, chunksize=FUSION_CHUNK_SIZE):
+    """Fuse customers_clean_2 with an in-memory item_clean through COPY
+
+    customers are streamed one month at a time through a server-side cursor,
+    each month an index range scan on event_time. Every month is committed
+    together with its fusion_progress row, so a run that stops is resumed
+    from the first month not finished, unless the inputs were rebuilt since.
+    """
+    cursor = conn.cursor()
+    cursor.execute(sql_create_fusion_progress)
+    cursor.execute(sql_fusion_source)
+    source = cursor.fetchone()[0]
+    cursor.execute("SELECT slice_start FROM fusion_progress WHERE source = %s", (source,))
+    finished = {row[0] for row in cursor.fetchall()}
+    if not finished:
+        cursor.execute(sql_reset_fusion)
+    execute(cursor, sql_index_fusion_source, step="fusion index customers_clean_2")
+    conn.commit()
+
+    items = load_items(cursor)
+    cursor.execute(sql_fusion_slices)
+    slices = cursor.fetchall()
+    estimated_rows = slices[0][2] if slices else 0
+    copy_query = sql.SQL("COPY new_customers_3 ({}) FROM STDIN WITH (FORMAT csv)").format(
+        sql.SQL(', ').join(map(sql.Identifier, CUSTOMER_COLUMNS + ITEM_COLUMNS)))
+
+    with tqdm(total=max(estimated_rows, 0), unit=' rows') as progress:
+        for slice_start, slice_end, _ in slices:
+            if slice_start in finished:
+                continue
+            written = 0
+            with measure(f"fusion stream {slice_start}", conn) as record:
+                with conn.cursor(name='fusion_stream') as reader:
+                    reader.itersize = chunksize
+                    reader.execute(sql_stream_slice, (slice_start, slice_end))
+                    while True:
+                        rows = reader.fetchmany(chunksize)
+                        if not rows:
+                            break
+                        chunk = enrich_chunk(pd.DataFrame(rows, columns=CUSTOMER_COLUMNS), items)
+                        buffer = io.StringIO()
+                        chunk.to_csv(buffer, index=False, header=False)
+                        buffer.seek(0)
+                        cursor.copy_expert(copy_query, buffer)
+                        written += len(chunk)
+                        progress.update(len(rows))
+                cursor.execute("INSERT INTO fusion_progress (slice_start, rows_written, source) VALUES (%s, %s, %s)",
+                               (slice_start, written, source))
+                conn.commit()
+                record["rows"] = written
+            progress.write(f"{slice_start} fused, {written} rows.")
+    cursor.close()
+
+
+def rename_relations(cursor, old_name, new_name):
+    """Rename a table with its partitions and indexes, replacing the old name prefix"""
+    cursor.execute(sql_table_relations, (old_name,))
+    for relkind, relname in cursor.fetchall():
+        if not relname.startswith(old_name):
+            continue
+        kind = sql.SQL("INDEX") if relkind in ('i', 'I') else sql.SQL("TABLE")
+        cursor.execute(sql.SQL("ALTER {} {} RENAME TO {}").format(
+            kind, sql.Identifier(relname), sql.Identifier(new_name + relname[len(old_name):])))
+
+
+def swap_fusion(conn, retries=FUSION_SWAP_RETRIES):
+    """Index and analyze new_customers_3, then swap it with customers
+
+    The previous customers is kept as customers_backup. The swap only takes
+    its exclusive locks for a few renames, and gives up after lock_timeout
+    instead of queueing readers behind it, retrying until it gets a quiet
+    moment.
+    """
+    cursor = conn.cursor()
+    execute(cursor, sql_finalize_fusion, step="fusion index and analyze")
+    cursor.execute(sql_create_fusion_progress)
+    conn.commit()
+
+    for attempt in range(1, retries + 1):
+        try:
+            cursor.execute("SET LOCAL lock_timeout = %s", (FUSION_LOCK_TIMEOUT,))
+            cursor.execute("DROP TABLE IF EXISTS customers_backup")
+            rename_relations(cursor, 'customers', 'customers_backup')
+            rename_relations(cursor, 'new_customers_3', 'customers')
+            cursor.execute("DELETE FROM fusion_progress")
+            conn.commit()
+            print("Swapped 'new_customers_3' into 'customers', previous one kept as 'customers_backup'.")
+            break
+        except psycopg2.errors.LockNotAvailable:
+            conn.rollback()
+            print(f"Swap attempt {attempt} timed out waiting for locks, retrying.")
+            time.sleep(min(0.1 * 2 ** attempt, 5))
+    else:
+        raise Exception(f"Could not swap 'customers' after {retries} attempts")
+    cursor.close()
+
+
 def backup_and_fusion_tables():
     """Backup the customers table and fuse it with the item table"""
 
-    conn = psycopg2.connect(
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        host=DB_HOST,
-        port=DB_PORT
-    )
+    conn = get_connection()
     print("Connected to postgres!")
     cursor = conn.cursor()
     
     try:
-        cursor.execute(sql_fusion)
-        print("Tables 'customers' and 'item' have been fused into 'new_customers'.")
-        
-        """ cursor.execute(sql_rename)
-        print("Renamed 'new_customers' to 'customers' and 'customers' to 'old_customers'.")
-         """
+        if FUSION_MODE == 'parallel':
+            parallel_fusion(cursor)
+        elif FUSION_MODE == 'stream':
+            stream_fusion(conn)
+        else:
+            execute(cursor, sql_fusion, step="fusion")
         conn.commit()
+        print("Tables 'customers' and 'item' have been fused into 'new_customers_3'.")
 
-    except Exception as error:
-        print(f"An error occurred: {error}")
+        swap_fusion(conn)
+
+    except Exception:
         conn.rollback()
+        raise
 
     finally:
         cursor.close()
-        conn.close()
+        release_connection(conn)
 
 
 if __name__ == "__main__":
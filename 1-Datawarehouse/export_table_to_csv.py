@@ -1,42 +1,243 @@
-import psycopg2
+from psycopg2 import sql
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import gzip
+import hashlib
+import json
 import os
-from dotenv import load_dotenv
+import zstandard
+import pyarrow as pa
+import pyarrow.parquet as pq
 import time
+from db import get_connection, release_connection
 
-load_dotenv(dotenv_path="../.env")
+EXPORT_TABLE = os.getenv('EXPORT_TABLE', 'customers')
+EXPORT_DIR = os.getenv('EXPORT_DIR', '/app/export')
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', 8))
+EXPORT_COMPRESSION = os.getenv('EXPORT_COMPRESSION', 'zstd')
+EXPORT_FORMAT = os.getenv('EXPORT_FORMAT', 'csv')
+EXPORT_ROW_GROUP_SIZE = int(os.getenv('EXPORT_ROW_GROUP_SIZE', 1000000))
+EXPORT_SORT = os.getenv('EXPORT_SORT', 'event_time')
 
-DB_NAME = os.getenv('POSTGRES_DB')
-DB_USER = os.getenv('POSTGRES_USER')
-DB_PASSWORD = os.getenv('POSTGRES_PASSWORD')
-DB_HOST = os.getenv('POSTGRES_HOST', 'postgres')
-DB_PORT = os.getenv('POSTGRES_PORT', '5432')
+COMPRESSION_EXTENSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
 
-def export_table_to_csv(table_name: str):
-	"""Export a table to a CSV file"""
+#arrow types of the postgres type oids found in our tables, anything else is exported as text
+ARROW_TYPES = {
+    16: pa.bool_(),
+    20: pa.int64(),
+    21: pa.int16(),
+    23: pa.int32(),
+    700: pa.float32(),
+    701: pa.float64(),
+    1700: pa.float64(),
+    1114: pa.timestamp('us'),
+    1184: pa.timestamp('us', tz='UTC'),
+}
+DICTIONARY_COLUMNS = ['event_type', 'brand', 'category_code']
 
-    conn = psycopg2.connect(
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        host=DB_HOST,
-        port=DB_PORT
-    )
+#leaf partitions of a table, empty if it isn't partitioned
+sql_leaf_partitions = """
+SELECT relid::regclass::text FROM pg_partition_tree(%s) WHERE isleaf AND level > 0 ORDER BY relid::regclass::text;
+"""
+
+sql_table_pages = """
+SELECT GREATEST(pg_relation_size(%s::regclass) / current_setting('block_size')::int, 1);
+"""
+
+
+class HashingWriter:
+    """File wrapper that counts and hashes the bytes written through it"""
+
+    def __init__(self, file):
+        self.file = file
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.bytes += len(data)
+        return self.file.write(data)
+
+
+def open_compressed(file, compression: str):
+    """Wrap a binary file with the chosen compression"""
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=file, mode='wb', compresslevel=6)
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor(level=3, threads=1).stream_writer(file, closefd=False)
+    return file
+
+
+def plan_shards(cursor, table_name: str, workers: int) -> list:
+    """Split a table in shards, one per partition or a range of pages each
+
+    Page ranges are read with ctid conditions, which Postgres runs as TID
+    range scans that only touch their own pages.
+    """
+    cursor.execute(sql_leaf_partitions, (table_name,))
+    partitions = [row[0] for row in cursor.fetchall()]
+    if partitions:
+        return [(partition, sql.SQL("SELECT * FROM {}").format(sql.SQL(partition))) for partition in partitions]
+
+    cursor.execute(sql_table_pages, (table_name,))
+    pages = cursor.fetchone()[0]
+    step = -(-pages // workers)
+    shards = []
+    for number, start in enumerate(range(0, pages, step)):
+        query = sql.SQL("SELECT * FROM {} WHERE ctid >= {}::tid").format(
+            sql.Identifier(table_name), sql.Literal(f"({start},0)"))
+        if start + step < pages:
+            query = sql.SQL("{} AND ctid < {}::tid").format(query, sql.Literal(f"({start + step},0)"))
+        shards.append((f"{table_name}_{number:03d}", query))
+    return shards
+
+
+def export_shard(snapshot: str, name: str, query, compression: str) -> dict:
+    """COPY one shard to a compressed CSV file inside the exported snapshot"""
+    conn = get_connection()
+    path = os.path.join(EXPORT_DIR, f"{name}.csv{COMPRESSION_EXTENSIONS[compression]}")
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+        with open(path, 'wb') as f:
+            hashed = HashingWriter(f)
+            compressed = open_compressed(hashed, compression)
+            cursor.copy_expert(sql.SQL("COPY ({}) TO STDOUT WITH CSV HEADER").format(query), compressed)
+            if compressed is not hashed:
+                compressed.close()
+        rows = cursor.rowcount
+        conn.commit()
+        cursor.close()
+    finally:
+        release_connection(conn)
+    return {"file": os.path.basename(path), "rows": rows, "bytes": hashed.bytes, "sha256": hashed.sha256.hexdigest()}
+
+
+def arrow_schema(description) -> pa.Schema:
+    """Build the arrow schema of a cursor description"""
+    return pa.schema([(column.name, ARROW_TYPES.get(column.type_code, pa.string())) for column in description])
+
+
+def rows_to_table(rows, schema: pa.Schema) -> pa.Table:
+    """Turn fetched rows into an arrow table, column by column"""
+    columns = list(zip(*rows))
+    arrays = []
+    for field, values in zip(schema, columns):
+        if pa.types.is_floating(field.type):
+            values = [None if value is None else float(value) for value in values]
+        elif pa.types.is_string(field.type):
+            values = [None if value is None else str(value) for value in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def export_shard_parquet(snapshot: str, name: str, query, compression: str,
+                         row_group_size: int = EXPORT_ROW_GROUP_SIZE) -> dict:
+    """Stream one shard into a Parquet file inside the exported snapshot
+
+    Every fetch of row_group_size rows becomes one row group, with min/max
+    statistics on every column and dictionary encoding on the low
+    cardinality text columns.
+    """
+    conn = get_connection()
+    path = os.path.join(EXPORT_DIR, f"{name}.parquet")
+    rows = 0
+    writer = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+        with conn.cursor(name=f"export_{name}") as reader:
+            reader.itersize = row_group_size
+            reader.execute(query)
+            while True:
+                batch = reader.fetchmany(row_group_size)
+                if writer is None:
+                    schema = arrow_schema(reader.description)
+                    writer = pq.ParquetWriter(
+                        path, schema,
+                        compression=compression,
+                        use_dictionary=[column for column in DICTIONARY_COLUMNS if column in schema.names],
+                        write_statistics=True)
+                if not batch:
+                    break
+                writer.write_table(rows_to_table(batch, schema), row_group_size=row_group_size)
+                rows += len(batch)
+        writer.close()
+        conn.commit()
+        cursor.close()
+    finally:
+        release_connection(conn)
+    return {"file": os.path.basename(path), "rows": rows, "bytes": os.path.getsize(path), "sha256": file_hash(path)}
+
+
+def file_hash(path):
+    """Hash the content of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def export_table_to_csv(table_name: str, workers: int = EXPORT_WORKERS, compression: str = EXPORT_COMPRESSION,
+                        export_format: str = EXPORT_FORMAT):
+    """Export a table to compressed CSV or Parquet shards in parallel, with a manifest
+
+    Every shard runs on its own connection, all of them in the snapshot
+    exported by this connection, so together they are one consistent copy.
+    Parquet shards are sorted by EXPORT_SORT when the table has that column,
+    so the row group statistics let readers skip time ranges.
+    """
+    conn = get_connection()
+    conn.set_session(isolation_level='REPEATABLE READ')
     print("Connected to postgres!")
+    os.makedirs(EXPORT_DIR, exist_ok=True)
 
     cursor = conn.cursor()
-    output_query = f"COPY (SELECT * FROM {table_name}) TO STDOUT WITH CSV HEADER"
-    with open(f'/app/{tablename + ".csv"}', 'w') as f:
-        cursor.copy_expert(output_query, f)
-        print(f"Table {table_name} has been exported to {table_name + ".csv"}")
+    try:
+        cursor.execute("SELECT pg_export_snapshot(), now()")
+        snapshot, snapshot_time = cursor.fetchone()
+        shards = plan_shards(cursor, table_name, workers)
+        exporter = export_shard
+        if export_format == 'parquet':
+            exporter = export_shard_parquet
+            cursor.execute(sql.SQL("SELECT * FROM {} LIMIT 0").format(sql.Identifier(table_name)))
+            if EXPORT_SORT in [column.name for column in cursor.description]:
+                shards = [(name, sql.SQL("{} ORDER BY {}").format(query, sql.Identifier(EXPORT_SORT)))
+                          for name, query in shards]
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(exporter, snapshot, name, query, compression): name
+                       for name, query in shards}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                print(f"Shard {futures[future]} exported, {results[futures[future]]['rows']} rows.")
+
+        manifest = {
+            "table": table_name,
+            "snapshot_time": snapshot_time.isoformat(),
+            "format": export_format,
+            "compression": compression,
+            "rows": sum(result["rows"] for result in results.values()),
+            "shards": [results[name] for name, _ in shards]
+        }
+        with open(os.path.join(EXPORT_DIR, f"{table_name}.manifest.json"), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        print(f"Table {table_name} has been exported to {len(shards)} shards, {manifest['rows']} rows.")
+
+    finally:
+        conn.rollback()
+        cursor.close()
+        release_connection(conn)
 
-    cursor.close()
-    conn.close()
 
 if __name__ == "__main__":
     start_time = time.time()
     try:
-        export_table_to_csv("table_name")
+        export_table_to_csv(EXPORT_TABLE)
     except Exception as error:
         print(f"An error occurred: {error}")
-    
+
     print(f"--- {time.time() - start_time} seconds ---")
@@ -0,0 +1,194 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import hashlib
+import importlib.util
+import json
+import os
+import re
+import sys
+import time
+from metrics import measure
+from db import get_connection, release_connection
+
+PIPELINE_WORKERS = int(os.getenv('PIPELINE_WORKERS', 2))
+PIPELINE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MONTHLY_TABLES = '^data_[0-9]{4}_(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)$'
+
+#name, script, function, input tables (a leading ^ makes it a regex), output tables
+#the analyst scripts are mounted at /2-Dataanalyst, the rollup runs after the cleaning of customers
+STEPS = [
+    ("customers_2", "ex01/customers_table.py", "build_customers", [MONTHLY_TABLES], ["customers_2"]),
+    ("item_clean", "ex02/remove_duplicates.py", "clean_items", ["item"], ["item_clean"]),
+    ("customers_clean_2", "ex02/remove_duplicates.py", "clean_customers", ["customers_2"], ["customers_clean_2"]),
+    ("customers", "ex03/fusion.py", "backup_and_fusion_tables", ["customers_clean_2", "item_clean"], ["customers"]),
+    ("customers_unique", "remove_dups.py", "remove_dups", ["customers"], ["customers_unique"]),
+    ("customers2", "../2-Dataanalyst/customers_cleaning.py", "refresh_customers2", ["customers"], ["customers2"]),
+    ("customers_daily", "../2-Dataanalyst/daily_rollup.py", "refresh_daily_rollup", ["customers", "customers2"],
+     ["customers_daily", "customers_daily_spend"]),
+]
+
+sql_create_state = """
+CREATE TABLE IF NOT EXISTS pipeline_state (
+    step TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    finished_at TIMESTAMP NOT NULL DEFAULT now()
+);
+"""
+
+sql_get_state = """
+SELECT fingerprint FROM pipeline_state WHERE step = %s;
+"""
+
+sql_set_state = """
+INSERT INTO pipeline_state (step, fingerprint) VALUES (%s, %s)
+ON CONFLICT (step) DO UPDATE SET fingerprint = EXCLUDED.fingerprint, finished_at = now();
+"""
+
+#storage and write counters of the matching tables and all their partitions
+sql_table_fingerprints = """
+WITH RECURSIVE tree AS (
+    SELECT c.oid, c.relname AS root
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p') AND c.relname ~ ANY(%s)
+    UNION ALL
+    SELECT i.inhrelid, tree.root FROM pg_inherits i JOIN tree ON i.inhparent = tree.oid
+)
+SELECT tree.root, c.relname, c.oid, c.relfilenode,
+       s.n_tup_ins - s.n_tup_del AS row_count, s.n_tup_upd
+FROM tree
+JOIN pg_class c ON c.oid = tree.oid
+LEFT JOIN pg_stat_user_tables s ON s.relid = tree.oid
+ORDER BY tree.root, c.relname;
+"""
+
+sql_existing_tables = """
+SELECT relname FROM pg_class WHERE relkind IN ('r', 'p') AND relname = ANY(%s);
+"""
+
+
+def load_step(script: str, function: str):
+    """Import a step function from its script, which runs from its own folder"""
+    path = os.path.join(PIPELINE_DIR, script)
+    name = re.sub(r'\W', '_', os.path.splitext(os.path.normpath(script))[0])
+    module = sys.modules.get(name)
+    if module is None:
+        sys.path.insert(0, os.path.dirname(path))
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules[name] = module
+    return getattr(module, function)
+
+
+def input_fingerprint(cursor, inputs: list) -> str:
+    """Hash the row counts, write counters and storage of the input tables
+
+    The counters come from pg_stat_user_tables and relfilenode changes when
+    a table is rebuilt, so any load, delete, truncate or recreation of an
+    input changes the fingerprint. Vacuum and analyze don't.
+    """
+    patterns = [table if table.startswith('^') else f"^{re.escape(table)}$" for table in inputs]
+    cursor.execute(sql_table_fingerprints, (patterns,))
+    rows = [list(row) for row in cursor.fetchall()]
+    return hashlib.sha256(json.dumps(rows, default=str).encode()).hexdigest()
+
+
+def is_up_to_date(cursor, step) -> tuple:
+    """Compare the input fingerprint of a step with the one of its last run"""
+    name, _, _, inputs, outputs = step
+    fingerprint = input_fingerprint(cursor, inputs)
+    cursor.execute(sql_existing_tables, (outputs,))
+    if len(cursor.fetchall()) < len(outputs):
+        return False, fingerprint
+    cursor.execute(sql_get_state, (name,))
+    row = cursor.fetchone()
+    return row is not None and row[0] == fingerprint, fingerprint
+
+
+def run_step(step, force: bool = False) -> bool:
+    """Run a step unless its inputs are unchanged since its last run
+
+    No connection is held while the step runs, the step takes its own from
+    the pool.
+    """
+    name, script, function, _, _ = step
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            up_to_date, fingerprint = is_up_to_date(cursor, step)
+        conn.rollback()
+    finally:
+        release_connection(conn)
+    if up_to_date and not force:
+        print(f"[{name}] up to date, skipped.")
+        return False
+
+    print(f"[{name}] running {script}:{function}")
+    start_time = time.time()
+    with measure(f"pipeline {name}", script=script):
+        load_step(script, function)()
+
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql_set_state, (name, fingerprint))
+        conn.commit()
+    finally:
+        release_connection(conn)
+    print(f"[{name}] done in {time.time() - start_time:.2f} seconds.")
+    return True
+
+
+def dependencies(steps: list) -> dict:
+    """Map every step to the steps producing its inputs"""
+    producers = {output: step[0] for step in steps for output in step[4]}
+    return {step[0]: {producers[table] for table in step[3] if table in producers} for step in steps}
+
+
+def run_pipeline(steps: list = STEPS, workers: int = PIPELINE_WORKERS, force: list = ()):
+    """Run the steps in dependency order, independent steps at the same time"""
+    by_name = {step[0]: step for step in steps}
+    for _, script, function, _, _ in steps:
+        load_step(script, function)
+    conn = get_connection()
+    with conn.cursor() as cursor:
+        cursor.execute(sql_create_state)
+    conn.commit()
+    release_connection(conn)
+
+    waiting = dependencies(steps)
+    done, failed, running = set(), set(), {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while waiting or running:
+            for name in [name for name, needs in waiting.items() if needs <= done]:
+                running[executor.submit(run_step, by_name[name], name in force)] = name
+                del waiting[name]
+            for name in [name for name, needs in waiting.items() if needs & failed]:
+                print(f"[{name}] skipped, an input step failed.")
+                failed.add(name)
+                del waiting[name]
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    done.add(name)
+                except Exception as error:
+                    print(f"[{name}] failed: {error}")
+                    failed.add(name)
+    return not failed
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+
+    try:
+        if not run_pipeline(force=sys.argv[1:]):
+            sys.exit(1)
+    except Exception as error:
+        print(f"An error occurred: {error}")
+
+    print(f"--- {time.time() - start_time} seconds ---")
@@ -1,17 +1,9 @@
-import psycopg2
-from dotenv import load_dotenv
-import os
 import time
-
-load_dotenv(dotenv_path="../.env")
-
-DB_NAME = os.getenv('POSTGRES_DB')
-DB_USER = os.getenv('POSTGRES_USER')
-DB_PASSWORD = os.getenv('POSTGRES_PASSWORD')
-DB_HOST = 'postgres'
-DB_PORT = '5432'
+from metrics import execute
+from db import get_connection, release_connection
 
 sql_remove_dups = """
+DROP TABLE IF EXISTS customers_unique;
 CREATE TABLE customers_unique AS
 SELECT DISTINCT * FROM customers;
 """
@@ -19,22 +11,16 @@ SELECT DISTINCT * FROM customers;
 def remove_dups():
     """Remove duplicates from the fusion table"""
     
-    conn = psycopg2.connect(
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        host=DB_HOST,
-        port=DB_PORT
-    )
+    conn = get_connection()
     print("Connected to postgres!")
     cursor = conn.cursor()
-    cursor.execute(sql_remove_dups)
+    execute(cursor, sql_remove_dups, step="customers_unique")
     print("Removed duplicates from 'fusion'.")
 
     conn.commit()
 
     cursor.close()
-    conn.close()
+    release_connection(conn)
 
 if __name__ == "__main__":
 
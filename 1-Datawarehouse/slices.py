@@ -0,0 +1,60 @@
+from psycopg2 import sql
+import os
+import re
+from db import DB_POOL_SIZE
+
+#partition key of a table listed by user_id % slices, as pg_get_partkeydef shows it
+USER_SLICES_KEY = re.compile(r"LIST \(+user_id % (\d+)\)+")
+
+sql_partition_key = """
+SELECT pg_get_partkeydef(to_regclass(%s)), (SELECT COUNT(*) FROM pg_inherits WHERE inhparent = to_regclass(%s));
+"""
+
+sql_create_slices = """
+DROP TABLE IF EXISTS {table};
+CREATE TABLE {table} (LIKE {source}) PARTITION BY LIST ((user_id % {slices}));
+"""
+
+sql_create_slice = """
+CREATE UNLOGGED TABLE {partition} PARTITION OF {table} FOR VALUES IN ({slice});
+"""
+
+
+def default_workers() -> int:
+    """Slices run at once by default, one pooled connection is left to the caller"""
+    return max(1, min(os.cpu_count() or 1, DB_POOL_SIZE - 1))
+
+
+def slices_table(source: str) -> str:
+    """Name of the table a source is split into"""
+    return f"{source}_slices"
+
+
+def slice_source(cursor, source: str, slices: int) -> str:
+    """Get a relation where user_id % slices = n only reads one partition
+
+    A source already listed by user_id % slices is used as is. Any other
+    one is split in a single pass into the UNLOGGED partitions of
+    {source}_slices, so the slices don't each scan the whole source.
+    """
+    cursor.execute(sql_partition_key, (source, source))
+    key, partitions = cursor.fetchone()
+    match = USER_SLICES_KEY.fullmatch(key or '')
+    if match and int(match.group(1)) == slices and partitions == slices:
+        return source
+
+    table = slices_table(source)
+    cursor.execute(sql.SQL(sql_create_slices).format(
+        table=sql.Identifier(table), source=sql.Identifier(source), slices=sql.Literal(slices)))
+    for slice_number in range(slices):
+        cursor.execute(sql.SQL(sql_create_slice).format(
+            partition=sql.Identifier(f"{table}_p{slice_number}"), table=sql.Identifier(table),
+            slice=sql.Literal(slice_number)))
+    cursor.execute(sql.SQL("INSERT INTO {} SELECT * FROM {}").format(sql.Identifier(table), sql.Identifier(source)))
+    cursor.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table)))
+    return table
+
+
+def drop_slices(cursor, source: str):
+    """Drop the table a source was split into, if any"""
+    cursor.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(slices_table(source))))
@@ -0,0 +1,229 @@
+from psycopg2 import sql
+import csv
+import io
+import os
+import time
+from db import get_connection, release_connection
+
+CLEANING_MODE = os.getenv('CLEANING_MODE', 'incremental')
+CLEANING_ENGINE = os.getenv('CLEANING_ENGINE', 'sql')
+CLEANING_BATCH_SIZE = int(os.getenv('CLEANING_BATCH_SIZE', 100000))
+
+#same query as query_customers_cleaning.sql, over the customers rows of {source}
+sql_clean_sessions = """
+WITH event_sequence AS (
+    SELECT *,
+           SUM(CASE WHEN event_type = 'cart' THEN 1 ELSE 0 END)
+               OVER (PARTITION BY user_session, product_id ORDER BY event_time) as cart_count,
+           SUM(CASE WHEN event_type = 'remove_from_cart' THEN 1 ELSE 0 END)
+               OVER (PARTITION BY user_session, product_id ORDER BY event_time) as remove_count
+    FROM {source} AS customers
+    WHERE event_type IN ('cart', 'remove_from_cart', 'purchase', 'view')
+),
+valid_events AS (
+    SELECT *,
+           cart_count - remove_count as cart_status,
+           CASE
+               WHEN event_type = 'remove_from_cart' AND cart_count > remove_count - 1 THEN 1
+               ELSE 0
+           END as valid_remove
+    FROM event_sequence
+)
+SELECT *
+FROM valid_events
+WHERE event_type = 'view'
+   OR event_type = 'cart'
+   OR (event_type = 'remove_from_cart' AND valid_remove = 1)
+   OR (event_type = 'purchase' AND cart_status > 0)
+"""
+
+#rows of the sessions with an event after the watermark, NULL sessions form one session like in the
+#window partition; kept out of the IN so the planner semi-joins through the user_session indexes,
+#customers_user_session_idx comes with customers from the fusion
+sql_touched_customers = """(
+    SELECT * FROM customers WHERE user_session IN (SELECT user_session FROM touched_sessions)
+    UNION ALL
+    SELECT * FROM customers WHERE user_session IS NULL
+        AND EXISTS (SELECT 1 FROM touched_sessions WHERE user_session IS NULL)
+)"""
+
+sql_delete_touched = [
+    "DELETE FROM customers2 WHERE user_session IN (SELECT user_session FROM touched_sessions)",
+    """DELETE FROM customers2 WHERE user_session IS NULL
+        AND EXISTS (SELECT 1 FROM touched_sessions WHERE user_session IS NULL)""",
+]
+
+sql_create_state = """
+CREATE TABLE IF NOT EXISTS cleaning_state (
+    target TEXT PRIMARY KEY,
+    watermark TIMESTAMP NOT NULL,
+    refreshed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+"""
+
+sql_get_watermark = """
+SELECT watermark FROM cleaning_state WHERE target = 'customers2' AND to_regclass('customers2') IS NOT NULL;
+"""
+
+sql_set_watermark = """
+INSERT INTO cleaning_state (target, watermark) VALUES ('customers2', %s)
+ON CONFLICT (target) DO UPDATE SET watermark = EXCLUDED.watermark, refreshed_at = now();
+"""
+
+sql_create_customers2 = """
+DROP TABLE IF EXISTS customers2;
+CREATE TABLE customers2 AS
+SELECT *, 0::bigint AS cart_count, 0::bigint AS remove_count, 0::bigint AS cart_status, 0 AS valid_remove
+FROM customers
+WITH NO DATA;
+"""
+
+sql_touched_sessions = """
+CREATE TEMP TABLE touched_sessions ON COMMIT DROP AS
+SELECT DISTINCT user_session FROM customers WHERE event_time > %s;
+ANALYZE touched_sessions;
+"""
+
+sql_stream_sessions = """
+SELECT * FROM {source} AS customers
+WHERE event_type IN ('cart', 'remove_from_cart', 'purchase', 'view')
+ORDER BY user_session, product_id, event_time;
+"""
+
+
+def clean_group(rows: list, columns: list) -> list:
+    """Clean the events of one (user_session, product_id), sorted by event_time
+
+    Events with the same event_time are peers of the SQL window: they all
+    see the cart and remove counts including every one of them.
+    """
+    event_type = columns.index('event_type')
+    event_time = columns.index('event_time')
+    cart_count = remove_count = 0
+    kept = []
+    start = 0
+    while start < len(rows):
+        end = start
+        while end < len(rows) and rows[end][event_time] == rows[start][event_time]:
+            cart_count += rows[end][event_type] == 'cart'
+            remove_count += rows[end][event_type] == 'remove_from_cart'
+            end += 1
+        cart_status = cart_count - remove_count
+        for row in rows[start:end]:
+            valid_remove = int(row[event_type] == 'remove_from_cart' and cart_count > remove_count - 1)
+            if (row[event_type] in ('view', 'cart') or valid_remove
+                    or (row[event_type] == 'purchase' and cart_status > 0)):
+                kept.append(row + (cart_count, remove_count, cart_status, valid_remove))
+        start = end
+    return kept
+
+
+def stream_clean(conn, source: str, batch_size: int = CLEANING_BATCH_SIZE) -> int:
+    """Clean the sessions in session order through a server-side cursor and COPY
+
+    Only the events of one (user_session, product_id) are held at a time.
+    """
+    written = 0
+    with conn.cursor(name='cleaning_stream') as reader, conn.cursor() as writer:
+        reader.itersize = batch_size
+        reader.execute(sql_stream_sessions.format(source=source))
+        columns = None
+        group, group_key, kept = [], None, []
+
+        def flush():
+            nonlocal written
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(kept)
+            buffer.seek(0)
+            writer.copy_expert(sql.SQL("COPY customers2 ({}) FROM STDIN WITH (FORMAT csv)").format(
+                sql.SQL(', ').join(map(sql.Identifier, columns + ['cart_count', 'remove_count',
+                                                                  'cart_status', 'valid_remove']))), buffer)
+            written += len(kept)
+            kept.clear()
+
+        while True:
+            rows = reader.fetchmany(batch_size)
+            if columns is None:
+                columns = [column.name for column in reader.description]
+                session, product = columns.index('user_session'), columns.index('product_id')
+            if not rows:
+                break
+            for row in rows:
+                key = (row[session], row[product])
+                if key != group_key:
+                    kept.extend(clean_group(group, columns))
+                    group, group_key = [], key
+                group.append(row)
+            if len(kept) >= batch_size:
+                flush()
+        kept.extend(clean_group(group, columns))
+        flush()
+    return written
+
+
+def clean(cursor, source: str) -> int:
+    """Insert the cleaned events of the source rows into customers2 with the chosen engine"""
+    if CLEANING_ENGINE == 'stream':
+        return stream_clean(cursor.connection, source)
+    cursor.execute(f"INSERT INTO customers2 {sql_clean_sessions.format(source=source)}")
+    return cursor.rowcount
+
+
+def refresh_customers2(mode: str = CLEANING_MODE):
+    """Rebuild customers2, or only the sessions with events after the last refresh
+
+    Every session with a new event is deleted from customers2 and cleaned
+    again from all its events, so the running cart counts stay the same as
+    a full rebuild. Everything runs in one repeatable read transaction.
+    Events loaded with an event_time before the watermark need mode='full'.
+    """
+    conn = get_connection()
+    conn.set_session(isolation_level='REPEATABLE READ')
+    print("Connected to postgres!")
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute(sql_create_state)
+        cursor.execute(sql_get_watermark)
+        row = cursor.fetchone()
+        cursor.execute("SELECT MAX(event_time) FROM customers")
+        watermark = cursor.fetchone()[0]
+
+        if mode == 'full' or row is None:
+            cursor.execute(sql_create_customers2)
+            rows = clean(cursor, "customers")
+            print(f"customers2 rebuilt, {rows} rows.")
+        else:
+            cursor.execute(sql_touched_sessions, (row[0],))
+            cursor.execute("SELECT COUNT(*) FROM touched_sessions")
+            touched = cursor.fetchone()[0]
+            deleted = 0
+            for query in sql_delete_touched:
+                cursor.execute(query)
+                deleted += cursor.rowcount
+            rows = clean(cursor, sql_touched_customers)
+            print(f"{touched} sessions refreshed since {row[0]}, {deleted} rows replaced by {rows}.")
+
+        cursor.execute("CREATE INDEX IF NOT EXISTS customers2_user_session_idx ON customers2 (user_session)")
+        if watermark is not None:
+            cursor.execute(sql_set_watermark, (watermark,))
+        conn.commit()
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+
+    try:
+        refresh_customers2()
+    except Exception as error:
+        print(f"An error occurred: {error}")
+
+    print(f"--- {time.time() - start_time} seconds ---")
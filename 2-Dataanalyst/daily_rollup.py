@@ -0,0 +1,112 @@
+import os
+import time
+from db import get_connection, release_connection
+
+ROLLUP_MODE = os.getenv('ROLLUP_MODE', 'incremental')
+
+sql_create_state = """
+CREATE TABLE IF NOT EXISTS rollup_state (
+    target TEXT PRIMARY KEY,
+    watermark TIMESTAMP NOT NULL,
+    refreshed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+"""
+
+sql_get_watermark = """
+SELECT watermark FROM rollup_state WHERE target = 'customers_daily'
+    AND to_regclass('customers_daily') IS NOT NULL AND to_regclass('customers_daily_spend') IS NOT NULL;
+"""
+
+sql_set_watermark = """
+INSERT INTO rollup_state (target, watermark) VALUES ('customers_daily', %s)
+ON CONFLICT (target) DO UPDATE SET watermark = EXCLUDED.watermark, refreshed_at = now();
+"""
+
+#the rollups take the column types of customers, users are counted exactly per day
+sql_create_rollups = """
+CREATE TABLE IF NOT EXISTS customers_daily AS
+SELECT DATE(event_time) AS day, event_type, COUNT(*) AS events, SUM(price) AS total_price,
+       COUNT(DISTINCT user_id) AS distinct_users
+FROM customers
+GROUP BY 1, 2
+WITH NO DATA;
+CREATE UNIQUE INDEX IF NOT EXISTS customers_daily_day_event_type_idx ON customers_daily (day, event_type);
+
+CREATE TABLE IF NOT EXISTS customers_daily_spend AS
+SELECT DATE(event_time) AS day, user_id, COUNT(*) AS purchases, SUM(price) AS spend
+FROM customers
+GROUP BY 1, 2
+WITH NO DATA;
+CREATE UNIQUE INDEX IF NOT EXISTS customers_daily_spend_day_user_id_idx ON customers_daily_spend (day, user_id);
+"""
+
+sql_delete_days = """
+DELETE FROM customers_daily WHERE day >= %(since)s;
+DELETE FROM customers_daily_spend WHERE day >= %(since)s;
+"""
+
+sql_insert_days = """
+INSERT INTO customers_daily
+SELECT DATE(event_time), event_type, COUNT(*), SUM(price), COUNT(DISTINCT user_id)
+FROM customers
+WHERE event_time >= %(since)s
+GROUP BY 1, 2;
+
+INSERT INTO customers_daily_spend
+SELECT DATE(event_time), user_id, COUNT(*), SUM(price)
+FROM customers
+WHERE event_type = 'purchase' AND event_time >= %(since)s
+GROUP BY 1, 2;
+
+ANALYZE customers_daily;
+ANALYZE customers_daily_spend;
+"""
+
+
+def refresh_daily_rollup(mode: str = ROLLUP_MODE):
+    """Refresh the daily rollups from the day of the last loaded event on
+
+    The days from the previous watermark on are deleted and aggregated
+    again, so a day that was partly loaded is completed. Events loaded with
+    an event_time before the watermark need mode='full'.
+    """
+    conn = get_connection()
+    conn.set_session(isolation_level='REPEATABLE READ')
+    print("Connected to postgres!")
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute(sql_create_state)
+        cursor.execute(sql_get_watermark)
+        row = cursor.fetchone()
+        cursor.execute(sql_create_rollups)
+        cursor.execute("SELECT MAX(event_time) FROM customers")
+        watermark = cursor.fetchone()[0]
+
+        since = '-infinity' if mode == 'full' or row is None else row[0].date()
+        cursor.execute(sql_delete_days, {"since": since})
+        cursor.execute(sql_insert_days, {"since": since})
+        print(f"Daily rollups refreshed from {since}.")
+
+        if watermark is not None:
+            cursor.execute(sql_set_watermark, (watermark,))
+        conn.commit()
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+
+    try:
+        refresh_daily_rollup()
+    except Exception as error:
+        print(f"An error occurred: {error}")
+
+    print(f"--- {time.time() - start_time} seconds ---")
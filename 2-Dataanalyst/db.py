@@ -0,0 +1,119 @@
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from sqlalchemy import create_engine
+from dotenv import load_dotenv
+from contextlib import contextmanager
+import psycopg2
+import threading
+import os
+
+load_dotenv(dotenv_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env'))
+
+DB_NAME = os.getenv('POSTGRES_DB')
+DB_USER = os.getenv('POSTGRES_USER')
+DB_PASSWORD = os.getenv('POSTGRES_PASSWORD')
+DB_HOST = os.getenv('POSTGRES_HOST', 'postgres')
+DB_PORT = os.getenv('POSTGRES_PORT', '5432')
+
+DATABASE_URL = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
+
+#connections one process may hold at once, from the pool and from the engine each
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 8))
+#seconds to wait for a free pooled connection before giving up
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 300))
+
+lock = threading.Lock()
+pool = None
+pool_slots = None
+pool_pid = None
+engine = None
+engine_pid = None
+
+
+def get_pool() -> ThreadedConnectionPool:
+    """Get the connection pool of this process, creating it on first use
+
+    A process forked after the pool was created gets its own pool, the
+    parent's connections are left to the parent.
+    """
+    global pool, pool_slots, pool_pid
+    with lock:
+        if pool is None or pool_pid != os.getpid():
+            pool = ThreadedConnectionPool(
+                0, DB_POOL_SIZE,
+                dbname=DB_NAME,
+                user=DB_USER,
+                password=DB_PASSWORD,
+                host=DB_HOST,
+                port=DB_PORT
+            )
+            pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+            pool_pid = os.getpid()
+        return pool
+
+
+def is_healthy(conn) -> bool:
+    """Check that a pooled connection still answers"""
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def get_connection():
+    """Take a healthy connection from the pool, waiting up to DB_POOL_TIMEOUT while all are in use"""
+    connection_pool = get_pool()
+    if not pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise PoolError(f"No pooled connection free after {DB_POOL_TIMEOUT:g} seconds, all {DB_POOL_SIZE} "
+                        "are in use; raise DB_POOL_SIZE or lower the workers")
+    try:
+        for _ in range(DB_POOL_SIZE + 1):
+            conn = connection_pool.getconn()
+            if is_healthy(conn):
+                return conn
+            connection_pool.putconn(conn, close=True)
+        raise psycopg2.OperationalError("No healthy connection available")
+    except Exception:
+        pool_slots.release()
+        raise
+
+
+def release_connection(conn):
+    """Give a connection back to the pool with its session settings reset"""
+    broken = conn.closed
+    if not broken:
+        try:
+            conn.reset()
+            conn.set_session(isolation_level='DEFAULT', readonly='DEFAULT', deferrable='DEFAULT', autocommit=False)
+        except psycopg2.Error:
+            broken = True
+    try:
+        get_pool().putconn(conn, close=broken)
+    finally:
+        pool_slots.release()
+
+
+@contextmanager
+def connection():
+    """Borrow a pooled connection for the duration of a with block"""
+    conn = get_connection()
+    try:
+        yield conn
+    finally:
+        release_connection(conn)
+
+
+def get_engine():
+    """Get the SQLAlchemy engine of this process, bounded and pinging connections before use"""
+    global engine, engine_pid
+    with lock:
+        if engine is not None and engine_pid != os.getpid():
+            engine.dispose(close=False)
+        if engine is None or engine_pid != os.getpid():
+            engine = create_engine(DATABASE_URL, pool_size=DB_POOL_SIZE, max_overflow=0, pool_pre_ping=True)
+            engine_pid = os.getpid()
+        return engine
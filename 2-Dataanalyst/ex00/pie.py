@@ -1,44 +1,27 @@
-from sqlalchemy import create_engine
 import pandas as pd
-from dotenv import load_dotenv
 import os
+import sys
 import matplotlib.pyplot as plt
-from tqdm import tqdm
 
 
-load_dotenv(dotenv_path="../.env")
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import get_engine  # noqa: E402
 
-DB_NAME = os.getenv('POSTGRES_DB')
-DB_USER = os.getenv('POSTGRES_USER')
-DB_PASSWORD = os.getenv('POSTGRES_PASSWORD')
-DB_HOST = 'postgres'
-DB_PORT = '5432'
-
-query = "SELECT event_type FROM customers"
-
-total_rows_query = "SELECT COUNT(*) FROM customers"
-
-DATABASE_URL = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
+#kept by daily_rollup.py
+query = "SELECT event_type, SUM(events) AS events FROM customers_daily GROUP BY event_type"
 
 
 def get_event_type_data():
     """Get the event type data from the database"""
     
-    engine = create_engine(DATABASE_URL)
-    chunks = []
-    
-    total_rows = pd.read_sql(total_rows_query, engine).iloc[0, 0]
-    
-    for chunk in tqdm(pd.read_sql(query, engine, chunksize=10000), total=total_rows//10000, unit='chunk'):
-        chunks.append(chunk)
-    df = pd.concat(chunks, ignore_index=True)
-    return df
+    engine = get_engine()
+    return pd.read_sql(query, engine)
 
 
 def plot_pie_chart(data):
     """Plot a pie chart of the event type distribution"""
 
-    event_counts = data['event_type'].value_counts()
+    event_counts = data.set_index('event_type')['events'].sort_values(ascending=False)
     plt.figure(figsize=(8, 8))
     plt.pie(event_counts, labels=event_counts.index, autopct='%1.1f%%', startangle=140)
     plt.title('Distribution of Event Types')
@@ -1,64 +1,32 @@
-from sqlalchemy import create_engine
 import pandas as pd
-from dotenv import load_dotenv
 import os
+import sys
 import matplotlib.pyplot as plt
-from tqdm import tqdm
 import time
 
 
-load_dotenv(dotenv_path="../.env")
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import get_engine  # noqa: E402
 
-DB_NAME = os.getenv('POSTGRES_DB')
-DB_USER = os.getenv('POSTGRES_USER')
-DB_PASSWORD = os.getenv('POSTGRES_PASSWORD')
-DB_HOST = 'postgres'
-DB_PORT = '5432'
-
-DATABASE_URL = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
-
-engine = create_engine(DATABASE_URL)
+engine = get_engine()
 
+#kept by daily_rollup.py
 query = """
 SELECT 
-    DATE(event_time) AS date,
-    COUNT(DISTINCT user_id) AS unique_users
+    day AS date,
+    distinct_users AS unique_users
 FROM 
-    customers
+    customers_daily
 WHERE 
     event_type = 'purchase'
-    AND event_time BETWEEN '2022-10-01' AND '2023-01-31'
-GROUP BY 
-    DATE(event_time)
+    AND day BETWEEN '2022-10-01' AND '2023-01-31'
 ORDER BY 
     date;
 """
 
-total_rows_query = """
-SELECT COUNT(*) AS total_days
-FROM (
-    SELECT 
-        DATE(event_time) AS date
-    FROM 
-        customers
-    WHERE 
-        event_type = 'purchase'
-        AND event_time BETWEEN '2022-10-01' AND '2023-01-31'
-    GROUP BY 
-        DATE(event_time)
-) AS daily_unique_users;
-"""
-
 
 def get_df():
-    chunks = []
-    
-    total_rows = pd.read_sql(total_rows_query, engine).iloc[0, 0]
-    
-    for chunk in tqdm(pd.read_sql(query, engine, chunksize=10000), total=total_rows//10000, unit='chunk'):
-        chunks.append(chunk)
-    df = pd.concat(chunks, ignore_index=True)
-    return df
+    return pd.read_sql(query, engine)
 
 
 def plot_daily_unique_customers(data):
@@ -1,23 +1,15 @@
-from sqlalchemy import create_engine
 import pandas as pd
-from dotenv import load_dotenv
 import os
+import sys
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import time
 
 
-load_dotenv(dotenv_path="../.env")
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import get_engine  # noqa: E402
 
-DB_NAME = os.getenv('POSTGRES_DB')
-DB_USER = os.getenv('POSTGRES_USER')
-DB_PASSWORD = os.getenv('POSTGRES_PASSWORD')
-DB_HOST = 'postgres'
-DB_PORT = '5432'
-
-DATABASE_URL = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
-
-engine = create_engine(DATABASE_URL)
+engine = get_engine()
 
 query = """
 SELECT 
@@ -1,42 +1,83 @@
 import os
+import shutil
+import subprocess
 import time
 
+CONTAINER = 'postgres'
+DB_USER = 'imontero'
+DB_NAME = 'piscineds'
+BACKUP_JOBS = int(os.getenv('BACKUP_JOBS', 4))
+BACKUP_COMPRESSION = os.getenv('BACKUP_COMPRESSION', '6')
+CONTAINER_BACKUP_DIR = '/tmp/backups'
 
-def backup_database(file_name: str):
-    """Backup the database to a file"""
-    print(f"Backing up database to {file_name}...")
-    os.system(f"docker exec -t postgres pg_dump -U imontero -d piscineds > {file_name}")
 
+def run(command: list):
+    """Run a command, streaming its output and failing on a non zero exit code"""
+    print(f"$ {' '.join(command)}")
+    subprocess.run(command, check=True)
 
-def backup_table(table_name: str, file_name: str):
-    """Backup a table to a file"""
-    print(f"Backing up {table_name} to {file_name}...")
-    os.system(f"docker exec -t postgres pg_dump -U imontero -d piscineds -t {table_name} > {file_name}")
 
+def dump(backup_dir: str, extra_args: list):
+    """Dump in directory format with parallel jobs inside the container, then copy it out"""
+    container_path = f"{CONTAINER_BACKUP_DIR}/{os.path.basename(backup_dir)}"
+    run(["docker", "exec", CONTAINER, "mkdir", "-p", CONTAINER_BACKUP_DIR])
+    run(["docker", "exec", CONTAINER, "rm", "-rf", container_path])
+    run(["docker", "exec", CONTAINER, "pg_dump", "-U", DB_USER, "-d", DB_NAME,
+         "-Fd", "-j", str(BACKUP_JOBS), "-Z", BACKUP_COMPRESSION, "-v", "-f", container_path] + extra_args)
+    shutil.rmtree(backup_dir, ignore_errors=True)
+    run(["docker", "cp", f"{CONTAINER}:{container_path}", backup_dir])
+    run(["docker", "exec", CONTAINER, "rm", "-rf", container_path])
 
-def restore_table(file_name: str):
-    """Restore a table from a file"""
-    print(f"Restoring {file_name}...")
-    os.system(f"docker exec -i postgres psql -U imontero -d piscineds -f {file_name}")
 
+def backup_database(backup_dir: str):
+    """Backup the database to a directory format backup"""
+    print(f"Backing up database to {backup_dir}...")
+    dump(backup_dir, [])
 
-def copy_backup_to_container(file_name: str):
-    """Copy a backup file to the container"""
-    print(f"Copying {file_name} to the container...")
-    os.system(f"docker cp {file_name} postgres:{file_name}")
+
+def backup_table(table_name: str, backup_dir: str):
+    """Backup a table to a directory format backup"""
+    print(f"Backing up {table_name} to {backup_dir}...")
+    dump(backup_dir, ["-t", table_name])
+
+
+def restore_table(backup_path: str):
+    """Restore a directory format backup with parallel jobs, or a plain SQL file"""
+    print(f"Restoring {backup_path}...")
+    container_path = copy_backup_to_container(backup_path)
+    if os.path.isdir(backup_path):
+        run(["docker", "exec", CONTAINER, "pg_restore", "-U", DB_USER, "-d", DB_NAME,
+             "-j", str(BACKUP_JOBS), "--clean", "--if-exists", "-v", container_path])
+    else:
+        run(["docker", "exec", CONTAINER, "psql", "-U", DB_USER, "-d", DB_NAME,
+             "-v", "ON_ERROR_STOP=1", "-f", container_path])
+    run(["docker", "exec", CONTAINER, "rm", "-rf", container_path])
+
+
+def copy_backup_to_container(backup_path: str) -> str:
+    """Copy a backup file or directory to the container"""
+    print(f"Copying {backup_path} to the container...")
+    container_path = f"{CONTAINER_BACKUP_DIR}/{os.path.basename(os.path.normpath(backup_path))}"
+    run(["docker", "exec", CONTAINER, "mkdir", "-p", CONTAINER_BACKUP_DIR])
+    run(["docker", "exec", CONTAINER, "rm", "-rf", container_path])
+    run(["docker", "cp", backup_path, f"{CONTAINER}:{container_path}"])
+    return container_path
 
 
 if __name__ == "__main__":
     
     start_time = time.time()
 
-    #backup_database("piscineds.sql")
+    try:
+        #backup_database("piscineds_backup")
 
-    #copy_backup_to_container("piscineds_customers.sql")
+        #copy_backup_to_container("piscineds_customers_backup")
 
-    #backup_table("customers", "piscineds_customers.sql")
-    
-    restore_table("piscineds_customers.sql")
+        #backup_table("customers", "piscineds_customers_backup")
+
+        restore_table("piscineds_customers_backup")
+    except subprocess.CalledProcessError as error:
+        print(f"An error occurred: {error}")
 
     print(f"--- {time.time() - start_time} seconds ---")
     
\ No newline at end of file